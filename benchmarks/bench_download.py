@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of the downloader against the local mock server (see
+mock_server.py): times the scraping of a course (get_downloadable_content),
+a single download() of a video, a complete download_course (and how long it
+takes to start the first file transfer) and a second download_course over
+the already downloaded course.
+
+Run with -h for the options, e.g., to compare worker counts on a slow server:
+
+    python benchmarks/bench_download.py --latency 0.05 --jobs 1
+    python benchmarks/bench_download.py --latency 0.05 --jobs 8
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'courseradownloader'))
+from courseradownloader import CourseraDownloader
+from metrics import Hooks
+from mock_server import MockConfig, MockCourseraServer
+from six import print_
+from util import format_bytes, parse_size
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def dir_size(dirname):
+    total = 0
+    for dirpath, _, filenames in os.walk(dirname):
+        total += sum(os.path.getsize(os.path.join(dirpath, f))
+                     for f in filenames)
+    return total
+
+
+def run(args):
+    config = MockConfig(weeks=args.weeks, classes=args.classes,
+                        resources=args.resources,
+                        with_video=not args.lookup_videos,
+                        video_size=args.video_size, file_size=args.file_size,
+                        latency=args.latency, failure_rate=args.failure_rate,
+                        cut_rate=args.cut_rate, ranges=not args.no_ranges)
+    server = MockCourseraServer(config).start()
+    workdir = tempfile.mkdtemp(prefix='coursera-dl-bench-')
+    results = {}
+    starts = []
+
+    try:
+        # the course structure cache is disabled, it would hide the scraping
+        # time of the later steps
+        downloader_class = server.configure(CourseraDownloader)
+        d = downloader_class('user', 'password', ignorefiles='',
+                             jobs=args.jobs, segments=args.segments,
+                             cache_dir=os.path.join(workdir, 'cache'),
+                             content_ttl=0, progress='none',
+                             hooks=[Hooks(on_resource_start=lambda r:
+                                          starts.append(r.started))])
+        d.login('bench-001')
+
+        quiet = open(os.devnull, 'w')
+        stdout = sys.stdout
+        sys.stdout = quiet
+        try:
+            results['scrape'], _ = timed(d.get_downloadable_content,
+                                         d.lecture_url_from_name('bench-001'))
+
+            single_dir = os.path.join(workdir, 'single')
+            os.makedirs(single_dir)
+            results['download'], _ = timed(
+                d.download, server.url + '/bench-001/files/w0c0.mp4',
+                target_dir=single_dir)
+
+            dest = os.path.join(workdir, 'courses')
+            server.stats.clear()
+            del starts[:]
+            course_start = time.time()
+            results['course'], _ = timed(d.download_course, 'bench-001', dest)
+            results['course_first_file'] = min(starts) - course_start
+            results['course_requests'] = server.stats.get('GET', 0)
+            results['course_bytes'] = dir_size(os.path.join(dest, 'bench-001'))
+
+            server.stats.clear()
+            results['rerun'], _ = timed(d.download_course, 'bench-001', dest)
+            results['rerun_requests'] = server.stats.get('GET', 0)
+        finally:
+            sys.stdout = stdout
+            quiet.close()
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark coursera-dl against a local mock server.')
+    parser.add_argument('--weeks', type=int, default=4)
+    parser.add_argument('--classes', type=int, default=5,
+                        help='classes per week')
+    parser.add_argument('--resources', type=int, default=2,
+                        help='non video resources per class')
+    parser.add_argument('--lookup-videos', action='store_true',
+                        help='leave the videos off the index, forcing a lecture page lookup per class')
+    parser.add_argument('--video-size', type=parse_size, default='5M')
+    parser.add_argument('--file-size', type=parse_size, default='200K')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of file requests failing with a 503')
+    parser.add_argument('--cut-rate', type=float, default=0.0,
+                        help='fraction of file transfers cut off half way')
+    parser.add_argument('--no-ranges', action='store_true',
+                        help='do not support Range requests')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.json:
+        print_(json.dumps(results, sort_keys=True))
+        return
+
+    print_("scrape course pages      %8.3f s" % results['scrape'])
+    print_("download() one video     %8.3f s" % results['download'])
+    print_("download_course          %8.3f s  %s/s, %d requests" %
+           (results['course'],
+            format_bytes(results['course_bytes'] / results['course']),
+            results['course_requests']))
+    print_("  first file started     %8.3f s" % results['course_first_file'])
+    print_("download_course (rerun)  %8.3f s  %d requests" %
+           (results['rerun'], results['rerun_requests']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Time the parsing of synthetic lecture index and lecture pages, comparing the
+plain html.parser full page parse (the old behaviour) with the parsers and
+SoupStrainer restricted parsing used by CourseraDownloader.
+
+usage: python benchmarks/bench_parse.py [weeks] [classes] [repeat]
+"""
+import os
+import sys
+import time
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'courseradownloader'))
+from courseradownloader import CourseraDownloader
+from synthetic import lecture_index, lecture_page
+from util import have_lxml
+
+
+def best_of(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    weeks = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    classes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    index = lecture_index('http://localhost', weeks, classes)
+    page = lecture_page('http://localhost/video.mp4')
+    print("lecture index: %d weeks x %d classes, %d KB; lecture page %d KB" %
+          (weeks, classes, len(index) // 1024, len(page) // 1024))
+
+    parsers = ['html.parser'] + (['lxml'] if have_lxml() else [])
+    configs = [(p, s) for p in parsers for s in (None, 'strainer')]
+
+    for parser, strainer in configs:
+        def parse_index():
+            kw = {'parse_only': CourseraDownloader.LECTURE_INDEX_STRAINER} \
+                if strainer else {}
+            soup = BeautifulSoup(index, parser, **kw)
+            weeks_found = soup.findAll("div", {"class": "course-item-list-header"})
+            assert len(weeks_found) == weeks
+
+        def parse_page():
+            kw = {'parse_only': CourseraDownloader.LECTURE_VIDEO_STRAINER} \
+                if strainer else {}
+            soup = BeautifulSoup(page, parser, **kw)
+            assert soup.find('source', type="video/mp4")
+
+        print("%-12s %-9s index: %7.1f ms   lecture page: %6.2f ms" %
+              (parser, strainer or 'full', best_of(parse_index, repeat) * 1000,
+               best_of(parse_page, repeat) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+A local HTTP server imitating the parts of coursera.org the downloader talks
+to, for benchmarking without hitting the live site:
+
+    /<course>/lecture/index        lecture index (see synthetic.lecture_index)
+    /<course>/class/index          course home page
+    /<course>/lecture/view?...     lecture page holding the video tag
+    /<course>/files/<name>         resources (videos are video_size byte mp4s)
+    /about?topic-id=<name>         the about json
+    /login                         sets the CAUTH cookie
+
+Resources support Range (and If-Range) requests, resources and the lecture
+index support conditional requests (ETag), and the server can inject
+latency, 503 errors and connections cut off mid-body.
+With require_auth, requests without a valid CAUTH cookie are redirected to
+the login page (pages) or refused with a 401 (files), and expire_sessions()
+logs everybody out.
+"""
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit
+from synthetic import lecture_index, lecture_page
+
+# content of the served files is this block repeated
+BLOCK = hashlib.sha1(b'coursera-dl').digest() * 3277
+
+
+class MockConfig(object):
+
+    """
+    What the mock server serves and how badly it behaves.
+
+    :keyword weeks: number of weeks per course
+    :keyword classes: number of classes per week
+    :keyword resources: number of (non video) resources per class
+    :keyword with_video: list the videos on the index page, otherwise they
+        have to be looked up on the lecture pages
+    :keyword video_size: size of the videos in bytes
+    :keyword file_size: size of the other resources in bytes
+    :keyword latency: seconds each request is delayed by
+    :keyword failure_rate: fraction of file requests answered with a 503
+    :keyword cut_rate: fraction of file responses cut off half way
+    :keyword ranges: support Range requests
+    :keyword require_auth: only serve logged in sessions
+    """
+
+    def __init__(self, weeks=4, classes=5, resources=2, with_video=True,
+                 video_size=5 * 1048576, file_size=200 * 1024, latency=0.0,
+                 failure_rate=0.0, cut_rate=0.0, ranges=True,
+                 require_auth=False):
+        self.weeks = weeks
+        self.classes = classes
+        self.resources = resources
+        self.with_video = with_video
+        self.video_size = video_size
+        self.file_size = file_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.cut_rate = cut_rate
+        self.ranges = ranges
+        self.require_auth = require_auth
+
+
+def mp4_header(size):
+    """
+    Start of a served video of the given size: the boxes of a (minimal) mp4
+    file, followed by a media data box making up the rest of the file.
+    """
+    return (struct.pack('>I4s4sI', 16, b'ftyp', b'isom', 0) +
+            struct.pack('>I4s', 8, b'moov') +
+            struct.pack('>I4s', size - 24, b'mdat'))
+
+
+def file_content(size, start=0, end=None, header=b''):
+    """
+    Bytes start..end (inclusive) of a served file of the given size, which
+    starts with header.
+    """
+    end = size - 1 if end is None else end
+    if start < len(header):
+        head = header[start:end + 1]
+        return head + (file_content(size, start + len(head), end)
+                       if start + len(head) <= end else b'')
+    out = []
+    pos = start
+    while pos <= end:
+        offset = pos % len(BLOCK)
+        chunk = BLOCK[offset:offset + end + 1 - pos]
+        out.append(chunk)
+        pos += len(chunk)
+    return b''.join(out)
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type='text/html', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.count('POST')
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        token = self.server.new_session()
+        self.send_body(b'{}', 'application/json',
+                       headers={'Set-Cookie': 'CAUTH=%s; Path=/' % token})
+
+    def logged_in(self):
+        m = re.search(r'CAUTH=([^;\s]+)', self.headers.get('Cookie', ''))
+        return bool(m) and m.group(1) in self.server.sessions
+
+    def do_GET(self):
+        config = self.server.config
+        self.server.count('GET')
+        if config.latency:
+            time.sleep(config.latency)
+
+        u = urlsplit(self.path)
+        base = self.server.url
+        parts = u.path.strip('/').split('/')
+
+        if u.path.endswith('/auth/auth_redirector'):
+            self.send_body(b'<html><body>login</body></html>',
+                           headers={'Set-Cookie': 'csrf_token=mock; Path=/'})
+        elif config.require_auth and u.path != '/about' and not self.logged_in():
+            self.server.count('unauthorized')
+            if len(parts) == 3 and parts[1] == 'files':
+                self.send_body(b'', status=401)
+            else:
+                self.send_body(b'', status=302, headers={
+                    'Location': '%s/%s/auth/auth_redirector?type=login' %
+                    (base, parts[0])})
+        elif u.path.endswith('/lecture/index'):
+            course_url = base + '/' + parts[0]
+            body = lecture_index(course_url, config.weeks, config.classes,
+                                 config.resources, config.with_video)
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.server.count('304')
+                self.send_body(b'', status=304)
+            else:
+                self.send_body(body, headers={
+                    'ETag': etag, 'Set-Cookie': 'csrf_token=mock; Path=/'})
+        elif u.path.endswith('/class/index'):
+            self.send_body(b'<html><body>home</body></html>')
+        elif u.path.endswith('/lecture/view'):
+            m = re.search(r'lecture_id=(\d+)_(\d+)', u.query)
+            video = '%s/%s/files/w%sc%s.mp4' % (base, parts[0], m.group(1), m.group(2))
+            self.send_body(lecture_page(video))
+        elif u.path == '/about':
+            self.send_body(json.dumps({'name': u.query}).encode('utf-8'),
+                           'application/json')
+        elif len(parts) == 3 and parts[1] == 'files':
+            self.send_file(parts[2])
+        else:
+            self.send_body(b'not found', status=404)
+
+    def send_file(self, name):
+        config = self.server.config
+        size = config.video_size if name.endswith('.mp4') else config.file_size
+        header = mp4_header(size) if name.endswith('.mp4') else b''
+        etag = '"%s-%d"' % (name, size)
+
+        if random.random() < config.failure_rate:
+            self.server.count('503')
+            self.send_body(b'', status=503, headers={'Retry-After': '0'})
+            return
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('304')
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        headers = {'ETag': etag}
+        if config.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+
+        start, end, status = 0, size - 1, 200
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        # a range for another version of the file gets the whole file
+        if_range = self.headers.get('If-Range')
+        if m and config.ranges and if_range in (None, etag):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            if start >= size:
+                self.send_body(b'', status=416,
+                               headers={'Content-Range': 'bytes */%d' % size})
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end + 1 - start))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+        cut = random.random() < config.cut_rate
+        if cut:
+            self.server.count('cut')
+            end = start + (end - start) // 2
+        pos = start
+        while pos <= end:
+            chunk_end = min(end, pos + 262143)
+            self.wfile.write(file_content(size, pos, chunk_end, header))
+            pos = chunk_end + 1
+        self.server.count('bytes', end + 1 - start)
+        if cut:
+            self.close_connection = True
+
+
+class MockCourseraServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """
+    The mock server, serving in a background thread once start() is called.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, config=None, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.config = config or MockConfig()
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.stats = {}
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        with self.lock:
+            token = 'mock%d' % random.getrandbits(64)
+            self.sessions.add(token)
+        return token
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def count(self, what, n=1):
+        with self.lock:
+            self.stats[what] = self.stats.get(what, 0) + n
+
+    def handle_error(self, request, client_address):
+        # clients closing connections early is expected
+        pass
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def configure(self, downloader_class):
+        """
+        Return a subclass of downloader_class that talks to this server
+        instead of coursera.org.
+        """
+        base = self.url + '/%s'
+        attrs = {
+            'BASE_URL': base,
+            'HOME_URL': base + '/class/index',
+            'LECTURE_URL': base + '/lecture/index',
+            'LOGIN_URL': self.url + '/login',
+            'ABOUT_URL': self.url + '/about?topic-id=%s',
+        }
+        return type('Mock' + downloader_class.__name__, (downloader_class,), attrs)
@@ -0,0 +1,61 @@
+"""
+Synthetic coursera pages used by the benchmarks.
+"""
+
+# filler resembling the navigation, sidebar and scripts of a real lecture
+# page, which the parser has to get through as well
+FILLER = ''.join(
+    '<div class="course-navbar-item"><a href="/class/item%d">Item %d</a>'
+    '<span class="icon">&nbsp;</span></div>' % (i, i) for i in range(200))
+SCRIPT = '<script type="text/javascript">%s</script>' % (
+    'var x = {"a": [1, 2, 3], "b": "<div>not a tag</div>"};\n' * 200)
+
+
+def lecture_index(base_url, weeks=12, classes=10, resources=3, with_video=True):
+    """
+    A lecture index page with the given number of weeks, classes per week
+    and resources per class. Without a video resource, the video of each
+    class has to be looked up on its lecture page.
+    """
+    out = ['<html><head><title>Lectures</title>', SCRIPT, '</head><body>',
+           '<div class="course-navbar">', FILLER, '</div>',
+           '<div class="course-item-list">']
+    for w in range(weeks):
+        out.append('<div class="course-item-list-header expanded">'
+                   '<h3><span class="icon-chevron-down"></span>&nbsp;'
+                   'Week %d: Synthetic topic number %d</h3></div>' % (w + 1, w))
+        out.append('<ul class="course-item-list-section-list">')
+        for c in range(classes):
+            out.append(
+                '<li class="unviewed"><a class="lecture-link" '
+                'data-modal-iframe="%s/lecture/view?lecture_id=%d_%d" '
+                'href="%s/lecture/%d_%d">Lecture %d.%d: synthetic class (1%d:3%d)'
+                '<div class="hidden">extra</div></a>'
+                '<div class="course-lecture-item-resource">'
+                % (base_url, w, c, base_url, w, c, w + 1, c + 1, c % 10, c % 10))
+            for r in range(resources):
+                ext = ('pdf', 'pptx', 'srt', 'txt')[r % 4]
+                out.append('<a target="_new" href="%s/files/w%dc%dr%d.%s">'
+                           '<i class="icon-file"></i></a>' %
+                           (base_url, w, c, r, ext))
+            if with_video:
+                out.append('<a target="_new" href="%s/files/w%dc%d.mp4">'
+                           '<i class="icon-download-alt"></i></a>' %
+                           (base_url, w, c))
+            out.append('</div></li>')
+        out.append('</ul>')
+    out.append('</div>')
+    out.append(FILLER)
+    out.append('</body></html>')
+    return ''.join(out).encode('utf-8')
+
+
+def lecture_page(video_url):
+    """
+    The page shown in the lecture modal, holding the video tag.
+    """
+    return ('<html><head>%s</head><body>%s<div class="video-container">'
+            '<video controls="controls">'
+            '<source type="video/webm" src="%s.webm">'
+            '<source type="video/mp4" src="%s"></video></div>%s</body></html>' %
+            (SCRIPT, FILLER, video_url, video_url, FILLER)).encode('utf-8')
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tarfile
+import threading
+from os import path
+from util import PART_EXT, SEGMENT_EXT, replace_file
+
+# tarfile compression of each archive format and the extension it gets
+ARCHIVE_FORMATS = {
+    'tar': ('', '.tar'),
+    'gz': ('gz', '.tar.gz'),
+    'bz2': ('bz2', '.tar.bz2'),
+    'xz': ('xz', '.tar.xz'),
+}
+
+
+class CourseArchive(object):
+
+    """
+    Tarball a course is streamed into while it downloads: every file is
+    added as soon as it is complete and then removed from disk, so the course
+    never needs to be stored twice. Whatever is left in the course directory
+    is added when the archive is closed, after which the directory is removed.
+
+    Use the 'tar' format for courses that are mostly video, it barely
+    compresses and the compression only costs time.
+    """
+
+    def __init__(self, course_dir, dest_dir, fmt='gz'):
+        compression, ext = ARCHIVE_FORMATS[fmt]
+        self.course_dir = course_dir
+        self.arcroot = path.basename(course_dir)
+        self.filename = path.join(dest_dir, self.arcroot + ext)
+        # an archive of an earlier run is only replaced once this one is
+        # complete
+        self.tmpname = self.filename + '.tmp'
+        self.tar = tarfile.open(self.tmpname, 'w:' + compression)
+        self.lock = threading.Lock()
+
+    def arcname(self, filepath):
+        return path.join(self.arcroot, path.relpath(filepath, self.course_dir))
+
+    def add(self, filepath):
+        """
+        Move a completed file into the archive.
+        """
+        with self.lock:
+            self.tar.add(filepath, arcname=self.arcname(filepath))
+            os.remove(filepath)
+
+    def close(self):
+        """
+        Add the remaining files of the course (skipping unfinished
+        downloads), close the archive, move it into place and remove the
+        course directory.
+        """
+        with self.lock:
+            for dirpath, dirnames, filenames in os.walk(self.course_dir):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    if fn.endswith(PART_EXT) or fn.endswith(SEGMENT_EXT):
+                        continue
+                    filepath = path.join(dirpath, fn)
+                    self.tar.add(filepath, arcname=self.arcname(filepath))
+            self.tar.close()
+        replace_file(self.tmpname, self.filename)
+        shutil.rmtree(self.course_dir)
@@ -1,20 +1,54 @@
 import _version
 import argparse
+import collections
+import contextlib
 import getpass
+import hashlib
 import json
 import netrc
 import os
 import platform
+import random
 import re
 import requests
 import shutil
 import sys
 import tarfile
+import threading
 import time
-from bs4 import BeautifulSoup
+from archive import ARCHIVE_FORMATS, CourseArchive
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from httpcache import HttpCache
+from manifest import MANIFEST_NAME, DownloadManifest, file_checksum
+from metrics import DownloadMetrics, JsonLines, StatusLine, format_summary
 from os import path
 from six import print_
+from renames import RenameIndex
+from sessioncache import SessionCache
+from store import ContentStore
+from workqueue import TODO, WorkQueue
 from util import *
+from verify import (BROKEN, OK, REPAIRED, UNVERIFIED, file_problem,
+                    fileobj_checksum, scan_file, scan_problem)
+
+# outcomes of a download
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# a downloadable resource of a course as generated by iter_resources: the
+# (1-based) number and topic of its week, the number and name of its lecture,
+# its url and the file name it should get (None to use the server's)
+Resource = collections.namedtuple(
+    'Resource', ['week', 'week_topic', 'lecture', 'lecture_name', 'url',
+                 'fname'])
+
+# errors that can break off a transfer that is worth resuming
+TRANSFER_ERRORS = (IncompleteDownloadError,
+                   requests.exceptions.ConnectionError,
+                   requests.exceptions.ChunkedEncodingError,
+                   requests.exceptions.Timeout)
 
 
 class CourseraDownloader(object):
@@ -27,9 +61,43 @@ class CourseraDownloader(object):
 
     :param username: username
     :param password: password
-    :keyword proxy: http proxy, eg: foo.bar.com:1234
+    :keyword proxy: http(s) proxy, eg: foo.bar.com:1234
     :keyword parser: xml parser
     :keyword ignorefiles: comma separated list of file extensions to skip (e.g., "ppt,srt")
+    :keyword jobs: number of resources to download in parallel
+    :keyword sync: revalidate pages with conditional requests instead of
+        downloading them again
+    :keyword cache_dir: where state is kept between runs
+    :keyword segments: number of parallel connections used for large files
+    :keyword content_ttl: how long (in seconds) the parsed structure of a
+        course is reused before the course is scraped again
+    :keyword refresh: ignore the cached course structure
+    :keyword max_connections: cap on the number of concurrent connections,
+        shared by all downloads and page fetches
+    :keyword limit_rate: maximum download speed in bytes per second, shared
+        by all downloads
+    :keyword max_requests: maximum number of requests per second
+    :keyword retries: how often to retry a failed request or interrupted
+        transfer
+    :keyword pool_connections: number of hosts to keep connection pools for
+    :keyword pool_maxsize: number of connections kept alive per host, by
+        default enough for all the download workers
+    :keyword progress: show the interactive status line: 'bar', 'none' or
+        'auto' (only when writing to a terminal)
+    :keyword metrics_file: file to append per-file and summary metrics to,
+        as JSON lines
+    :keyword store_dir: content addressed store shared by all courses,
+        resources already in it are linked instead of downloaded
+    :keyword session_cache: reuse the session of an earlier run (kept in
+        cache_dir) instead of logging in every time
+    :keyword hooks: list of metrics renderers (e.g., Hooks) told about
+        every download as it starts, progresses, completes or fails
+    :keyword queue_size: number of resources found while scraping a course
+        that may wait for a download worker, by default twice the number of
+        workers
+    :keyword fsync: flush every downloaded file to disk before it is
+        renamed into place, so a crash cannot leave a complete looking file
+        with missing data
     """
     BASE_URL = 'https://class.coursera.org/%s'
     HOME_URL = BASE_URL + '/class/index'
@@ -39,13 +107,47 @@ class CourseraDownloader(object):
     LOGIN_URL = "https://accounts.coursera.org/api/v1/login"
     ABOUT_URL = "https://www.coursera.org/maestro/api/topic/information?topic-id=%s"
 
+    # where requests end up when the session is not (or no longer) logged in
+    LOGIN_PAGE_RE = re.compile(r'auth_redirector|accounts\.coursera\.org|/login')
+
     # see
     # http://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser
-    DEFAULT_PARSER = "html.parser"
+    # lxml is a lot faster, use it when it is installed
+    DEFAULT_PARSER = "lxml" if have_lxml() else "html.parser"
+
+    # only the parts of the pages we look at are parsed: the weekly sections
+    # of the lecture index (their headers and lecture lists) and the video
+    # tag of a lecture page
+    LECTURE_INDEX_STRAINER = SoupStrainer(
+        attrs={'class': re.compile('course-item-list')})
+    LECTURE_VIDEO_STRAINER = SoupStrainer('source')
 
     # how long to try to open a URL before timing out
     TIMEOUT = 30.0
 
+    # files of at least this size are fetched in several segments in
+    # parallel (when enabled and supported by the server)
+    SEGMENT_MIN_SIZE = 64 * 1048576
+
+    # size of the buffer (one per thread) bodies are read into, and how
+    # often (in seconds) a download reports its progress to the metrics
+    BUFFER_SIZE = 524288
+    PROGRESS_INTERVAL = 0.1
+
+    # responses with these status codes are worth retrying, any other error
+    # status is taken to be permanent
+    RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    # the delay before retry n is picked at random from
+    # [0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n)] seconds, unless the server
+    # asked for a specific delay with Retry-After
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 60.0
+
+    # bodies up to this size are read before a response we do not need is
+    # closed, so its connection goes back to the pool instead of being dropped
+    DRAIN_LIMIT = 65536
+
     def __init__(self, username,
                  password,
                  proxy=None,
@@ -53,7 +155,26 @@ class CourseraDownloader(object):
                  ignorefiles=None,
                  max_path_part_len=None,
                  gzip_courses=False,
-                 wk_filter=None):
+                 wk_filter=None,
+                 jobs=1,
+                 sync=False,
+                 cache_dir=None,
+                 segments=1,
+                 content_ttl=86400,
+                 refresh=False,
+                 max_connections=None,
+                 limit_rate=None,
+                 max_requests=None,
+                 retries=3,
+                 pool_connections=10,
+                 pool_maxsize=None,
+                 progress='auto',
+                 metrics_file=None,
+                 store_dir=None,
+                 session_cache=True,
+                 hooks=None,
+                 queue_size=None,
+                 fsync=True):
 
         self.username = username
         self.password = password
@@ -62,28 +183,89 @@ class CourseraDownloader(object):
         # Split "ignorefiles" argument on commas, strip, remove prefixing dot
         # if there is one, and filter out empty tokens.
         self.ignorefiles = [x.strip()[1:] if x[0] == '.' else x.strip()
-                            for x in ignorefiles.split(',') if len(x)]
+                            for x in (ignorefiles or '').split(',') if len(x)]
 
         self.session = None
         self.proxy = proxy
         self.max_path_part_len = max_path_part_len
         self.gzip_courses = gzip_courses
+        self.jobs = max(1, jobs)
+        self.queue_size = queue_size or 2 * self.jobs
+        self.fsync = fsync
+        self.sync = sync
+        self.segments = max(1, segments)
+        self.retries = max(0, retries)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize or max(
+            10, max_connections or self.jobs * self.segments)
+        self.content_ttl = content_ttl
+        self.refresh = refresh
+        self.cache_dir = cache_dir or default_cache_dir()
+
+        # in sync mode scraped pages are cached with their validators
+        self.http_cache = None
+        if sync:
+            self.http_cache = HttpCache(path.join(self.cache_dir, 'http'))
+
+        # the session cookies are kept between runs, the lock makes sure an
+        # expired session is renewed by one worker only
+        self.session_cache = None
+        if session_cache:
+            self.session_cache = SessionCache(
+                path.join(self.cache_dir, 'sessions'), username)
+        self.login_class = None
+        self.auth_lock = threading.Lock()
+
+        # downloaded files are deduplicated across courses and runs
+        self.store = ContentStore(store_dir) if store_dir else None
+
+        # shared state for the download workers: the paths currently being
+        # written and a lock that serialises the skip/rename decisions made on
+        # the filesystem
+        self.inflight = set()
+        self.fs_lock = threading.Lock()
+
+        # per thread state: the course being downloaded and the metrics of
+        # the file being transferred
+        self.local = threading.local()
+
+        renderers = []
+        if progress == 'bar' or (progress == 'auto' and sys.stdout.isatty()):
+            renderers.append(StatusLine())
+        if metrics_file:
+            renderers.append(JsonLines(metrics_file))
+        renderers.extend(hooks or [])
+        self.metrics = DownloadMetrics(renderers)
+
+        self.connections = None
+        if max_connections:
+            self.connections = ConnectionLimiter(max_connections)
+
+        # global bandwidth and request rate limits
+        self.bandwidth = TokenBucket(limit_rate) if limit_rate else None
+        self.request_rate = TokenBucket(max_requests) if max_requests else None
 
         try:
-            self.wk_filter = map(
-                int, wk_filter.split(",")) if wk_filter else None
-        except Exception as e:
-            print_(
-                "Invalid week filter, should be a comma separated list of integers", e)
-            exit()
+            self.wk_filter = list(map(
+                int, wk_filter.split(","))) if wk_filter else None
+        except ValueError as e:
+            raise ValueError(
+                "Invalid week filter, should be a comma separated list of integers: %s" % e)
 
-    def login(self, className):
+    def login(self, className, reuse=True):
         """
-        Login into coursera and obtain the necessary session cookies.
+        Login into coursera and obtain the necessary session cookies. Unless
+        reuse is False, the session of an earlier run is used if it is still
+        logged in.
         """
-        s = requests.Session()
-        if self.proxy:
-            s.proxies = {'http': proxy}
+        self.login_class = className
+        if reuse and self.resume_session(className):
+            return
+        if not reuse and self.session_cache:
+            # the cached session is not to be trusted any more
+            self.session_cache.clear()
+
+        s = self.make_session()
 
         url = self.lecture_url_from_name(className)
         res = s.get(url, timeout=self.TIMEOUT)
@@ -111,6 +293,110 @@ class CourseraDownloader(object):
             raise Exception("Failed to authenticate as %s" % self.username)
 
         self.session = s
+        if self.session_cache:
+            try:
+                self.session_cache.save(s.cookies)
+            except (IOError, OSError) as e:
+                print_(" Warning: could not save the session: %s" % e)
+
+    def resume_session(self, className):
+        """
+        Try to continue the cached session. A session is only used if its
+        CAUTH cookie has not expired and a request for the lecture page of
+        the class is not sent to the login page, a cached session that fails
+        these checks is removed. Returns True on success.
+        """
+        jar = self.session_cache.load() if self.session_cache else None
+        if jar is None:
+            return False
+        if 'CAUTH' not in jar:
+            self.session_cache.clear()
+            return False
+
+        s = self.make_session()
+        s.cookies = jar
+        s.headers['Referer'] = 'https://www.coursera.org'
+        if 'csrf_token' in jar:
+            s.headers['X-CSRFToken'] = jar.get('csrf_token')
+
+        try:
+            res = s.get(self.lecture_url_from_name(className),
+                        timeout=self.TIMEOUT, allow_redirects=False,
+                        stream=True)
+        except requests.exceptions.RequestException:
+            return False
+        self.release_response(res)
+        if res.status_code != 200:
+            self.session_cache.clear()
+            return False
+
+        print_("Reusing the session of an earlier run")
+        self.session = s
+        return True
+
+    def login_required(self, response):
+        """
+        Check if a request was refused or redirected to the login page
+        because the session expired.
+        """
+        return response.status_code == 401 or bool(
+            response.history and self.LOGIN_PAGE_RE.search(response.url))
+
+    def renew_session(self, session):
+        """
+        Log in again after session turned out to have expired, unless another
+        worker has already done so.
+        """
+        with self.auth_lock:
+            if self.session is session:
+                print_("Session expired, logging in again")
+                self.login(self.login_class, reuse=False)
+
+    def make_session(self):
+        """
+        Create a session with connection pools large enough for the
+        configured concurrency, so parallel downloads reuse kept-alive
+        connections rather than opening (and negotiating TLS for) new ones.
+        """
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        if self.proxy:
+            s.proxies = {'http': self.proxy, 'https': self.proxy}
+        return s
+
+    def connection_stats(self):
+        """
+        Return the number of requests made and connections opened by the
+        session's connection pools, a measure of connection reuse.
+        """
+        nrequests = nconnections = 0
+        adapters = set(self.session.adapters.values()) if self.session else ()
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                nrequests += pool.num_requests
+                nconnections += pool.num_connections
+        return nrequests, nconnections
+
+    def release_response(self, response):
+        """
+        Close a response whose body is not needed. A small body is read first
+        so the connection can be reused.
+        """
+        try:
+            clen = int(response.headers.get('Content-Length', -1))
+            if 0 <= clen <= self.DRAIN_LIMIT:
+                response.content
+        except Exception:
+            pass
+        response.close()
 
     def course_name_from_url(self, course_url):
         """Given the course URL, return the name, e.g., algo2012-p2"""
@@ -128,47 +414,105 @@ class CourseraDownloader(object):
         else:
             return s
 
-    def get_response(self, url, retries=3, **kwargs):
+    @contextlib.contextmanager
+    def connection_slots(self, n=1):
+        """
+        Hold n of the connections allowed by max_connections (if set).
+        """
+        if not self.connections:
+            yield
+            return
+        self.connections.acquire(n)
+        try:
+            yield
+        finally:
+            self.connections.release(n)
+
+    def get_response(self, url, retries=None, **kwargs):
         """
-        Get the response
+        Get the response. Connection errors, timeouts and responses with a
+        status in RETRY_STATUSES are retried (self.retries times by default)
+        with an exponential backoff; other errors are raised immediately.
         """
+        if retries is None:
+            retries = self.retries
         kwargs.update(timeout=self.TIMEOUT, allow_redirects=True)
-        for i in range(retries):
+        renewed = False
+        for attempt in range(retries + 1):
+            if self.request_rate:
+                self.request_rate.consume()
+            r = None
             try:
-                r = self.session.get(url, **kwargs)
+                session = self.session
+                r = session.get(url, **kwargs)
+                # the session expired, log in again (once) and repeat
+                if not renewed and self.login_class and self.login_required(r):
+                    self.release_response(r)
+                    self.renew_session(session)
+                    renewed = True
+                    r = self.session.get(url, **kwargs)
                 r.raise_for_status()
-            except Exception as e:
-                # print_("Warning: Retrying to connect url:%s" % url)
-                pass
-            else:
                 return r
-        raise e
-
-    def get_headers(self, url):
+            except requests.exceptions.HTTPError as e:
+                self.release_response(r)
+                if r.status_code not in self.RETRY_STATUSES:
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+
+            if attempt < retries:
+                self.metrics.retry(getattr(self.local, 'record', None))
+                delay = self.retry_delay(attempt, r)
+                print_(" Warning: %s, retrying in %.1fs" % (error, delay))
+                time.sleep(delay)
+        raise error
+
+    def retry_delay(self, attempt, response=None):
         """
-        Get the headers
+        How long to wait before retry number attempt (counting from 0),
+        honouring the Retry-After header of the failed response if present.
         """
-        r = self.get_response(url, stream=True)
-        headers = r.headers
-        r.close()
-        return headers
+        if response is not None:
+            retry_after = retry_after_seconds(response.headers)
+            if retry_after is not None:
+                return retry_after
+        return random.uniform(0, min(self.BACKOFF_MAX,
+                                     self.BACKOFF_BASE * 2 ** attempt))
 
     def get_page(self, url):
         """
-        Get the content
+        Get the content. In sync mode a cached copy is revalidated with a
+        conditional request and reused if the server says it is unchanged.
         """
-        r = self.get_response(url)
-        page = r.content
-        r.close()
+        if not self.http_cache:
+            with self.connection_slots():
+                r = self.get_response(url)
+                page = r.content
+                r.close()
+            return page
+
+        with self.connection_slots():
+            r = self.get_response(
+                url, headers=self.http_cache.conditional_headers(url))
+            page = r.content
+            r.close()
+        if r.status_code == 304:
+            return self.http_cache.get_body(url)
+        self.http_cache.store(url, r.headers, page)
         return page
 
     def get_json(self, url):
         """
         Get the json data
         """
-        r = self.get_response(url)
-        data = r.json()
-        r.close()
+        if self.http_cache:
+            return json.loads(self.get_page(url).decode('utf-8'))
+        with self.connection_slots():
+            r = self.get_response(url)
+            data = r.json()
+            r.close()
         return data
 
     def get_downloadable_content(self, course_url):
@@ -181,14 +525,93 @@ class CourseraDownloader(object):
         # get the course name, and redirect to the course lecture page
         vidpage = self.get_page(course_url)
 
-        # extract the weekly classes
-        soup = BeautifulSoup(vidpage, self.parser)
+        weeklyTopics, missing = self.parse_lecture_index(vidpage)
+        self.resolve_videos(missing)
+        return weeklyTopics
+
+    def iter_resources(self, course_url):
+        """
+        Generate the downloadable resources of the course with the given
+        video lecture URL as Resource records, in course order and skipping
+        the weeks not in the week filter. The videos that have to be looked
+        up on their lecture pages are resolved in the background, in course
+        order, and the records of a class come out as soon as its video is
+        known, before the rest of the course is resolved (see
+        resolve_resources).
+        """
+        print_("* Collecting downloadable content from " + course_url)
+        weeklyTopics, missing = self.parse_lecture_index(
+            self.get_page(course_url))
+        return self.resolve_resources(weeklyTopics, missing)
 
+    def resolve_resources(self, weeklyTopics, missing=()):
+        """
+        Generate Resource records for the weeks returned by
+        parse_lecture_index (or get_downloadable_content), in course order
+        and skipping the weeks not in the week filter. The missing videos are
+        looked up in the background, in course order, and the resources of a
+        class are generated as soon as its video is known. The videos are
+        filled in weeklyTopics too.
+        """
+        weeks = [(j, weeklyTopic, weekClasses) for j, (weeklyTopic, weekClasses)
+                 in enumerate(weeklyTopics, start=1)
+                 if not self.wk_filter or j in self.wk_filter]
+        wanted = set(id(r) for _, _, weekClasses in weeks
+                     for _, r in weekClasses)
+        pending = [m for m in missing if id(m[2]) in wanted]
+
+        # resource list (by id) -> set once its video has been looked up
+        resolved = dict((id(m[2]), threading.Event()) for m in pending)
+        errors = []
+
+        def resolve(item):
+            try:
+                self.resolve_video(item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                resolved[id(item[2])].set()
+
+        if pending:
+            print_("* Looking up %d video(s) from their lecture pages" %
+                   len(pending))
+            t = threading.Thread(target=parallel_map,
+                                 args=(resolve, pending, self.jobs))
+            t.daemon = True
+            t.start()
+
+        for j, weeklyTopic, weekClasses in weeks:
+            for i, (className, classResources) in enumerate(weekClasses, start=1):
+                if id(classResources) in resolved:
+                    resolved[id(classResources)].wait()
+                if errors:
+                    raise errors[0]
+                for url, fname in classResources:
+                    yield Resource(j, weeklyTopic, i, className, url, fname)
+
+    def parse_lecture_index(self, vidpage):
+        """
+        Parse the lecture index page of a course into the list of weeks as
+        returned by get_downloadable_content and the list of
+        (lecture page url, class name, resource list) tuples of the classes
+        whose video is not on the index page (see resolve_videos).
+        """
         # extract the weekly classes
+        soup = BeautifulSoup(vidpage, self.parser,
+                             parse_only=self.LECTURE_INDEX_STRAINER)
         weeks = soup.findAll("div", {"class": "course-item-list-header"})
 
+        # fall back to parsing the whole page in case the markup changed
+        if not weeks:
+            soup = BeautifulSoup(vidpage, self.parser)
+            weeks = soup.findAll("div", {"class": "course-item-list-header"})
+
         weeklyTopics = []
 
+        # (lecture page url, class name, resource list) of the classes whose
+        # video needs to be looked up on the lecture page
+        missing = []
+
         # for each weekly class
         for week in weeks:
             # title of this weeks' classes
@@ -239,67 +662,587 @@ class CourseraDownloader(object):
                         # titles
                         resourceLinks.append((h, None))
 
-                # check if the video is included in the resources, if not, try
-                # do download it directly
+                # check if the video is included in the resources, if not,
+                # remember the lecture page so the video can be looked up
+                # once all the weeks have been parsed
                 hasvid = [x for x, _ in resourceLinks if x.find('.mp4') > 0]
                 if not hasvid:
                     ll = li.find('a', {'class': 'lecture-link'})
                     lurl = clean_url(ll['data-modal-iframe'])
-
-                    try:
-                        pg = self.get_page(lurl)
-                        bb = BeautifulSoup(pg, self.parser)
-                        vobj = bb.find('source', type="video/mp4")
-
-                        if not vobj:
-                            print_(
-                                " Warning: Failed to find video for %s" % className)
-                        else:
-                            vurl = clean_url(vobj['src'])
-                            # build the matching filename
-                            fn = className + ".mp4"
-                            resourceLinks.append((vurl, fn))
-
-                    except requests.exceptions.HTTPError as e:
-                        # sometimes there is a lecture without a vidio (e.g.,
-                        # genes-001) so this can happen.
-                        print_(
-                            " Warning: failed to open the direct video link %s: %s" % (lurl, e))
+                    missing.append((lurl, className, resourceLinks))
 
                 weekClasses.append((className, resourceLinks))
 
             weeklyTopics.append((weekTopic, weekClasses))
 
-        return weeklyTopics
+        return weeklyTopics, missing
 
-    def download(self, url, target_dir=".", target_fname=None):
+    def resolve_videos(self, missing):
         """
-        Download the url to the given filename
+        Look up the videos of the classes returned as missing by
+        parse_lecture_index on their lecture pages.
         """
+        # fetch the lecture pages of the videos that were not listed as a
+        # resource in parallel, filling in the resource lists in place so the
+        # week/class ordering is unaffected
+        if missing:
+            print_("* Looking up %d video(s) from their lecture pages" %
+                   len(missing))
+            for e in parallel_map(self.resolve_video, missing, self.jobs):
+                if isinstance(e, Exception):
+                    raise e
+
+    def resolve_video(self, item):
+        """
+        Look up the video of a (lecture page url, class name, resource list)
+        item returned as missing by parse_lecture_index and add it to the
+        resource list.
+        """
+        lurl, className, resourceLinks = item
+        try:
+            vurl = self.find_lecture_video(lurl)
+        except requests.exceptions.HTTPError as e:
+            # sometimes there is a lecture without a vidio (e.g.,
+            # genes-001) so this can happen.
+            print_(
+                " Warning: failed to open the direct video link %s: %s" % (lurl, e))
+            return
+        if not vurl:
+            print_(
+                " Warning: Failed to find video for %s" % className)
+            return
+        # build the matching filename
+        fn = className + ".mp4"
+        resourceLinks.append((vurl, fn))
 
-        url = url.replace("_fr&format=", "_en&format=")
+    def content_cache_file(self, cname):
+        return path.join(self.cache_dir, 'courses', cname + '.json')
 
-        # get the headers
-        headers = self.get_headers(url)
+    def get_cached_content(self, cname):
+        """
+        Return the downloadable content of the course as returned by
+        get_downloadable_content, reusing the structure cached by an earlier
+        run if it is recent enough.
+        """
+        weeklyTopics = self.load_cached_content(cname)
+        if weeklyTopics is None:
+            weeklyTopics = self.get_downloadable_content(
+                self.lecture_url_from_name(cname))
+            self.save_cached_content(cname, weeklyTopics)
+        return weeklyTopics
 
-        # get the content length (if present)
-        clen = int(headers.get('Content-Length', -1))
+    def load_cached_content(self, cname):
+        """
+        Return the course structure cached by an earlier run, None if there
+        is none recent enough. In sync mode the age does not matter, the
+        lecture index is revalidated instead and the structure is only
+        reused if it was parsed from the current version of the index.
+        """
+        cache_file = self.content_cache_file(cname)
+        if not self.refresh and self.content_ttl > 0 and path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                age = time.time() - cached['time']
+                if self.http_cache:
+                    fresh = cached.get('validators') and \
+                        cached['validators'] == self.index_validators(cname)
+                else:
+                    fresh = age < self.content_ttl
+                if fresh and \
+                        cached['max_path_part_len'] == self.max_path_part_len:
+                    if self.http_cache:
+                        print_("* Lecture index unchanged, using the cached course structure")
+                    else:
+                        print_("* Using the course structure cached %d minutes ago (use --refresh to update)" %
+                               (age // 60))
+                    return cached['weeklyTopics']
+            except (IOError, OSError, ValueError, KeyError) as e:
+                print_(" Warning: ignoring broken course cache %s: %s" %
+                       (cache_file, e))
+        return None
+
+    def index_validators(self, cname):
+        """
+        Revalidate the lecture index of a course (see get_page) and return
+        the validators of its current version.
+        """
+        url = self.lecture_url_from_name(cname)
+        self.get_page(url)
+        return self.http_cache.validators(url)
 
-        # build the absolute path we are going to write to
-        fname = target_fname or filename_from_header(
-            headers) or filename_from_url(url)
+    def save_cached_content(self, cname, weeklyTopics):
+        """
+        Cache the structure of a course for load_cached_content.
+        """
+        cache_file = self.content_cache_file(cname)
+
+        # do not cache an empty course, the honour code may not be accepted yet
+        if weeklyTopics and self.content_ttl > 0:
+            if not path.exists(path.dirname(cache_file)):
+                os.makedirs(path.dirname(cache_file))
+            validators = None
+            if self.http_cache:
+                validators = self.http_cache.validators(
+                    self.lecture_url_from_name(cname))
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'time': time.time(),
+                           'max_path_part_len': self.max_path_part_len,
+                           'validators': validators,
+                           'weeklyTopics': weeklyTopics}, f)
+            replace_file(cache_file + '.tmp', cache_file)
+
+    def find_lecture_video(self, lurl):
+        """
+        Given the url of a lecture page, return the url of its mp4 video or
+        None if the page has no video.
+        """
+        pg = self.get_page(lurl)
+        bb = BeautifulSoup(pg, self.parser,
+                           parse_only=self.LECTURE_VIDEO_STRAINER)
+        vobj = bb.find('source', type="video/mp4")
+        return clean_url(vobj['src']) if vobj else None
+
+    def download(self, url, target_dir=".", target_fname=None, manifest=None,
+                 revalidate=False, archive=None, use_store=True, renames=None):
+        """
+        Download the url to the given filename and return whether it was
+        DOWNLOADED, SKIPPED or FAILED. If a manifest is given,
+        resources it lists as downloaded to the same directory are skipped
+        without contacting the server and completed downloads are recorded.
+        With revalidate, such resources are instead requested conditionally
+        using the validators in the manifest and only skipped on a 304.
+        Completed downloads are moved into the archive, if one is given.
+        Unless use_store is False, resources found in the content store are
+        linked from there and completed downloads are added to it. Renamed
+        copies of the resource are looked up in the renames index (see
+        RenameIndex), by default in target_dir only.
+
+        A single request is used to both decide whether the file needs to be
+        downloaded and to stream its content.
+        """
 
-        # split off the extension
-        _, ext = path.splitext(fname)
+        url = url.replace("_fr&format=", "_en&format=")
 
-        # check if we should skip it (remember to remove the leading .)
+        # validators of the copy we have if it is being revalidated
+        conditional = None
+        if manifest:
+            entry = manifest.get(url)
+            if entry and self.manifest_entry_matches(manifest, entry,
+                                                     target_dir, target_fname):
+                if not revalidate:
+                    fname = path.basename(entry['path'])
+                    print_('    - "%s" already downloaded, skipping' % fname)
+                    return SKIPPED
+                conditional = validator_headers(entry)
+
+        store = self.store if use_store else None
+        if store and conditional is None:
+            entry = store.lookup(url)
+            if entry:
+                return self.link_from_store(entry, target_dir, target_fname,
+                                            manifest, archive, renames)
+
+        with self.connection_slots():
+            return self.download_file(url, target_dir, target_fname,
+                                      manifest, conditional, archive, store,
+                                      renames)
+
+    def download_file(self, url, target_dir, target_fname, manifest,
+                      conditional=None, archive=None, store=None,
+                      renames=None):
+        """
+        Does the actual work of download(), conditional holds the headers to
+        revalidate the copy described by the manifest with and completed
+        downloads are added to the store, if given.
+        """
+        # if we already know where the file goes, resume any partial download
+        # straight away
+        offset = 0
+        if target_fname:
+            offset = partial_size(path.join(target_dir, target_fname))
+
+        started = time.time()
+        response, offset = self.open_download(url, offset, conditional)
+        dl = False
+        try:
+            if response.status_code == 304:
+                print_('    - "%s" is unchanged, skipping' %
+                       (target_fname or filename_from_url(url)))
+                return SKIPPED
+
+            headers = response.headers
+
+            # get the content length of the whole file (if present)
+            clen = full_content_length(response)
+
+            # build the absolute path we are going to write to
+            fname = target_fname or filename_from_header(
+                headers) or filename_from_url(url)
+
+            # split off the extension
+            _, ext = path.splitext(fname)
+
+            # check if we should skip it (remember to remove the leading .)
+            if ext and ext[1:] in self.ignorefiles:
+                print_('    - skipping "%s" (extension ignored)' % fname)
+                return SKIPPED
+
+            filepath = path.join(target_dir, fname)
+
+            # decide whether to download under the lock so that two workers
+            # never rename the same existing file or write to the same path
+            with self.fs_lock:
+                if filepath in self.inflight:
+                    print_('    - "%s" is already being downloaded, skipping' % fname)
+                    return SKIPPED
+                # a revalidated file that was not answered with a 304 changed
+                if conditional is not None:
+                    dl = True
+                else:
+                    dl = self.should_download(filepath, fname, clen, renames)
+                if dl:
+                    self.inflight.add(filepath)
+
+            if not dl:
+                # a file that exactly matches the advertised size is taken to
+                # be complete, record it so it is not checked again next time
+                if manifest and clen > 0 and path.exists(filepath) and \
+                        path.getsize(filepath) == clen:
+                    manifest.record(url, filepath, headers)
+                return SKIPPED
+        finally:
+            # the response is only kept open to stream the body from
+            if not dl:
+                self.release_response(response)
+
+        record = self.metrics.start_file(
+            url, filepath, clen, getattr(self.local, 'course', None), started)
+        self.local.record = record
+        outcome = FAILED
+        try:
+            print_('    - Downloading %s' % fname)
+
+            # the partial file may only be known now (the name came from the
+            # response or an incomplete file was moved aside), in which case
+            # a second, ranged request is needed
+            partsize = partial_size(filepath)
+            if partsize != offset and not (offset == 0 and partsize == clen):
+                self.release_response(response)
+                response, offset = self.open_download(
+                    url, partsize, validator=if_range(headers))
+                headers = response.headers
+
+            if self.use_segments(response, offset, clen):
+                self.release_response(response)
+                checksum = self.download_segmented(
+                    url, filepath, clen, record, if_range(headers))
+            else:
+                # a transfer that breaks off is resumed from the partial file
+                attempt = 0
+                while True:
+                    try:
+                        checksum = self.write_response(
+                            response, filepath, offset, clen, record)
+                        break
+                    except TRANSFER_ERRORS as e:
+                        if attempt >= self.retries:
+                            raise
+                        self.metrics.retry(record)
+                        delay = self.retry_delay(attempt)
+                        attempt += 1
+                        print_('    - "%s" interrupted (%s), resuming in %.1fs' %
+                               (fname, e, delay))
+                        time.sleep(delay)
+                        response.close()
+                        response, offset = self.open_download(
+                            url, partial_size(filepath),
+                            validator=if_range(headers))
+                        headers = response.headers
+            if manifest:
+                manifest.record(url, filepath, headers, checksum)
+            if store:
+                store.add(url, filepath, checksum, headers)
+            if archive:
+                archive.add(filepath)
+            elif renames:
+                renames.add(filepath)
+            outcome = DOWNLOADED
+        except Exception as e:
+            print_("Failed to download url %s to %s: %s" % (url, filepath, e))
+            self.metrics.error(url, e, record)
+        finally:
+            response.close()
+            with self.fs_lock:
+                self.inflight.discard(filepath)
+            self.local.record = None
+            self.metrics.finish_file(record, outcome)
+        return outcome
+
+    def link_from_store(self, entry, target_dir, target_fname, manifest=None,
+                        archive=None, renames=None):
+        """
+        Put the stored copy of a resource (a store index entry) where
+        download() would have written it, without contacting the server.
+        """
+        fname = target_fname or entry['name']
+        _, ext = path.splitext(fname)
         if ext and ext[1:] in self.ignorefiles:
             print_('    - skipping "%s" (extension ignored)' % fname)
-            return
+            return SKIPPED
 
         filepath = path.join(target_dir, fname)
+        with self.fs_lock:
+            if filepath in self.inflight:
+                print_('    - "%s" is already being downloaded, skipping' % fname)
+                return SKIPPED
+            try:
+                self.store.link(entry, filepath)
+            except (IOError, OSError) as e:
+                print_("Failed to link %s from the store: %s" % (fname, e))
+                return FAILED
+
+        print_('    - "%s" found in the store, linked' % fname)
+        if manifest:
+            manifest.record(entry['url'], filepath,
+                            {'ETag': entry.get('etag'),
+                             'Last-Modified': entry.get('last_modified')},
+                            entry['sha1'])
+        if archive:
+            archive.add(filepath)
+        elif renames:
+            renames.add(filepath, entry['size'])
+        return SKIPPED
+
+    def open_download(self, url, offset=0, headers=None, validator=None):
+        """
+        Open a streaming response for url, sending the given extra headers.
+        If offset is given the download is resumed from there with a Range
+        request, which is made conditional on validator (see if_range), if
+        given, so a resource that changed in the meantime is sent whole
+        instead of being spliced onto the old data. Returns the response and
+        the offset the response body starts at, which is 0 if the server
+        could not (or would not) honour the range.
+        """
+        headers = dict(headers or {})
+        if offset:
+            range_headers = dict(headers, Range='bytes=%d-' % offset)
+            if validator:
+                range_headers['If-Range'] = validator
+            try:
+                response = self.get_response(url, stream=True,
+                                             headers=range_headers)
+            except requests.exceptions.HTTPError as e:
+                # 416: the partial file does not match what the server has,
+                # start again from scratch
+                if e.response is None or e.response.status_code != 416:
+                    raise
+            else:
+                crange = parse_content_range(response.headers)
+                if response.status_code == 206 and crange and crange[0] == offset:
+                    return response, offset
+                if response.status_code in (200, 304):
+                    # the server ignored the range and sent the whole file,
+                    # or there is nothing to send
+                    return response, 0
+                self.release_response(response)
+
+        return self.get_response(url, stream=True, headers=headers), 0
+
+    def write_response(self, response, filepath, offset=0, clen=-1, record=None):
+        """
+        Stream the body of response into filepath. The data is written to a
+        ".part" file first, appending to it if offset is given, and only
+        renamed to filepath once the download is complete. Progress is
+        reported to the metrics of the given file record. Returns the sha1
+        checksum of the file.
+        """
+        partpath = filepath + PART_EXT
+        name = path.basename(filepath)
+
+        if offset:
+            print_('    - resuming "%s" at %s' % (name, format_bytes(offset)))
+        elif path.exists(partpath):
+            if path.getsize(partpath) == clen:
+                # a previous run got everything but did not get to the rename
+                replace_file(partpath, filepath)
+                return file_checksum(filepath)
+            print_('    - could not resume "%s", restarting' % name)
+
+        # the checksum covers the data of the partial file we resume from
+        hasher = hashlib.sha1()
+        if offset:
+            file_checksum(partpath, hasher)
+
+        with open(partpath, 'ab' if offset else 'wb') as f:
+            if clen > 0:
+                preallocate(f, clen)
+            done_size = offset + self.copy_body(response, f, record, hasher)
+            if clen <= 0 or done_size >= clen:
+                self.sync_file(f)
+
+        if clen > 0 and done_size < clen:
+            raise IncompleteDownloadError(
+                "incomplete download (%d of %d bytes)" % (done_size, clen))
+
+        replace_file(partpath, filepath)
+        return hasher.hexdigest()
+
+    def copy_body(self, response, f, record=None, hasher=None, limit=-1):
+        """
+        Write the body of response (at most limit bytes of it, if limit is
+        not negative) to the file object f, updating hasher with the data.
+        The body is read into a buffer that is reused by all the downloads
+        of a thread, and progress is reported to the metrics of the file
+        record every PROGRESS_INTERVAL seconds rather than for every chunk.
+        Returns the number of bytes written.
+        """
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            buf = self.local.buffer = bytearray(self.BUFFER_SIZE)
+
+        written = 0
+        unreported = 0
+        reported = 0
+        try:
+            for data in iter_into(response, buf, limit):
+                n = len(data)
+                if self.bandwidth:
+                    self.bandwidth.consume(n)
+                f.write(data)
+                if hasher:
+                    hasher.update(data)
+                written += n
+                unreported += n
+                # the first chunk is reported right away, for the time to
+                # first byte
+                if record and time.time() - reported >= self.PROGRESS_INTERVAL:
+                    self.metrics.update(record, unreported)
+                    unreported = 0
+                    reported = time.time()
+        finally:
+            if record and unreported:
+                self.metrics.update(record, unreported)
+        return written
+
+    def sync_file(self, f):
+        """
+        Flush a file that was written completely to disk, see fsync.
+        """
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def use_segments(self, response, offset, clen):
+        """
+        Check if the file the response is for should be fetched with a
+        segmented download: it is large, the server supports ranges and we are
+        not resuming a partial single-stream download.
+        """
+        return (self.segments > 1 and response.status_code == 200 and
+                not offset and clen >= self.SEGMENT_MIN_SIZE and
+                response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+    def download_segmented(self, url, filepath, clen, record=None,
+                           validator=None):
+        """
+        Download url to filepath over up to self.segments parallel connections,
+        each fetching its own byte range into a preallocated file at the
+        right offset. A failing segment is retried from where it stopped.
+        The ranges are conditional on validator (see open_download), so the
+        segments all come from the same version of the resource. Returns the
+        sha1 checksum of the file.
+        """
+        # the connection of the caller is reused for the first segment, the
+        # others only get one if it is free right now, so downloads never wait
+        # on each other for connections
+        if self.connections:
+            extra = self.connections.try_acquire(self.segments - 1)
+        else:
+            extra = self.segments - 1
+        try:
+            return self.fetch_segments(url, filepath, clen, extra + 1, record,
+                                       validator)
+        finally:
+            if self.connections:
+                self.connections.release(extra)
+
+    def fetch_segments(self, url, filepath, clen, nsegments, record=None,
+                       validator=None):
+        segpath = filepath + SEGMENT_EXT
+        with open(segpath, 'wb') as f:
+            preallocate(f, clen)
+            f.truncate(clen)
+
+        def fetch_segment(bounds):
+            start, end = bounds
+            pos = start
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.metrics.retry(record)
+                    time.sleep(self.retry_delay(attempt - 1))
+                headers = {'Range': 'bytes=%d-%d' % (pos, end),
+                           'Accept-Encoding': 'identity'}
+                if validator:
+                    headers['If-Range'] = validator
+                try:
+                    r = self.get_response(url, stream=True, headers=headers)
+                    try:
+                        crange = parse_content_range(r.headers)
+                        if r.status_code != 206 or not crange or crange[0] != pos:
+                            raise Exception(
+                                "server did not honour range %d-%d" % (pos, end))
+                        with open(segpath, 'r+b') as f:
+                            f.seek(pos)
+                            try:
+                                self.copy_body(r, f, record,
+                                               limit=end + 1 - pos)
+                            finally:
+                                # a segment that breaks off is retried from
+                                # where it stopped
+                                pos = f.tell()
+                    finally:
+                        r.close()
+                except Exception as e:
+                    error = e
+                if pos > end:
+                    return
+            raise error or Exception(
+                "segment %d-%d ended at %d" % (start, end, pos))
+
+        print_('    - fetching "%s" in %d segments' %
+               (path.basename(filepath), nsegments))
+        results = parallel_map(
+            fetch_segment, segment_bounds(clen, nsegments), nsegments)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            os.remove(segpath)
+            raise errors[0]
+
+        with open(segpath, 'r+b') as f:
+            self.sync_file(f)
+            checksum = fileobj_checksum(f)
+        replace_file(segpath, filepath)
+        return checksum
+
+    def manifest_entry_matches(self, manifest, entry, target_dir, target_fname):
+        """
+        Check that a manifest entry describes the file download() would write
+        to, i.e., it lives in target_dir and has the requested name (if any).
+        """
+        filepath = manifest.abspath(entry)
+        if path.abspath(path.dirname(filepath)) != path.abspath(target_dir):
+            return False
+        return not target_fname or path.basename(filepath) == target_fname
 
-        dl = True
+    def should_download(self, filepath, fname, clen, renames=None):
+        """
+        Check what is already on disk for the given path and return True if
+        the resource needs to be (re)downloaded. A missing file may be found
+        under another name in the renames index, by default only the
+        directory of the file is searched.
+        """
         if path.exists(filepath):
             if clen > 0:
                 fs = path.getsize(filepath)
@@ -315,61 +1258,37 @@ class CourseraDownloader(object):
                 if delta > 2:
                     print_(
                         '    - "%s" seems incomplete, downloading again' % fname)
+                    # resume from what we have unless a newer partial
+                    # download is already around. A file linked from the
+                    # store is never appended to, that would change the blob.
+                    partpath = filepath + PART_EXT
+                    if renames:
+                        renames.remove(filepath)
+                    if os.stat(filepath).st_nlink > 1:
+                        os.remove(filepath)
+                    elif not path.exists(partpath) or path.getsize(partpath) < fs:
+                        replace_file(filepath, partpath)
+                    return True
                 else:
                     print_('    - "%s" already exists, skipping' % fname)
-                    dl = False
+                    return False
             else:
                 # missing or invalid content length
                 # assume all is ok...
-                dl = False
+                return False
         else:
             # Detect renamed files
-            existing, short = find_renamed(filepath, clen)
-            if existing:
+            if renames is None:
+                renames = RenameIndex(path.dirname(filepath), recursive=False)
+            existing = renames.find(filepath, clen) if clen > 0 else None
+            if existing and path.exists(existing):
                 print_('    - "%s" seems to be a copy of "%s", renaming existing file' %
-                       (fname, short))
+                       (fname, path.relpath(existing, renames.root)))
                 os.rename(existing, filepath)
-                dl = False
+                renames.move(existing, filepath)
+                return False
 
-        try:
-            if dl:
-                print_('    - Downloading', fname)
-                response = self.get_response(url, stream=True)
-                full_size = clen
-                done_size = 0
-                slice_size = 524288  # 512KB buffer
-                last_time = time.time()
-                with open(filepath, 'wb') as f:
-                    for data in response.iter_content(slice_size):
-                        f.write(data)
-                        try:
-                            percent = int(float(done_size) / full_size * 100)
-                        except:
-                            percent = 0
-                        try:
-                            cur_time = time.time()
-                            speed = float(slice_size) / float(
-                                cur_time - last_time)
-                            last_time = cur_time
-                        except:
-                            speed = 0
-                        if speed < 1024:
-                            speed_str = '{:.1f} B/s'.format(speed)
-                        elif speed < 1048576:
-                            speed_str = '{:.1f} KB/s'.format(speed / 1024)
-                        else:
-                            speed_str = '{:.1f} MB/s'.format(speed / 1048576)
-                        status_str = 'status: {:2d}% {}'.format(
-                            percent, speed_str)
-                        sys.stdout.write(
-                            status_str + ' ' * (25 - len(status_str)) + '\r')
-                        sys.stdout.flush()
-                        done_size += slice_size
-                response.close()
-                sys.stdout.write(' ' * 25 + '\r')
-                sys.stdout.flush()
-        except Exception as e:
-            print_("Failed to download url %s to %s: %s" % (url, filepath, e))
+        return True
 
     def download_about(self, cname, course_dir):
         """
@@ -389,25 +1308,151 @@ class CourseraDownloader(object):
             json_data = json.dumps(data, indent=4, separators=(',', ':'))
             f.write(json_data)
 
-    def download_course(self, cname, dest_dir=".", reverse_sections=False, gzip_courses=False):
+    def download_resources(self, tasks, manifest=None, archive=None,
+                           course=None, renames=None):
+        """
+        Download a list of (url, target_dir, target_fname) tuples using up to
+        self.jobs parallel workers, reporting aggregated progress. Returns a
+        dict with the number of resources downloaded, skipped and failed and,
+        under 'resources', the url, target_dir, fname and outcome of each
+        task, in order.
+
+        tasks can also be a generator, which is consumed as the downloads
+        proceed: a task is downloaded as soon as a worker is free, with at
+        most self.queue_size tasks produced ahead of the workers.
+        """
+        if isinstance(tasks, list):
+            print_(" - Downloading %d resources using %d worker(s)" %
+                   (len(tasks), self.jobs))
+        else:
+            print_(" - Downloading resources as they are found using %d worker(s)" %
+                   self.jobs)
+
+        stats = dict((outcome, 0) for outcome in (DOWNLOADED, SKIPPED, FAILED))
+
+        def fetch(task):
+            url, target_dir, tfname = task
+            self.local.course = course
+            try:
+                outcome = self.download(url, target_dir=target_dir,
+                                        target_fname=tfname, manifest=manifest,
+                                        archive=archive, renames=renames)
+            except Exception as e:
+                print_("    - failed: ", url, e)
+                self.metrics.error(url, e)
+                outcome = FAILED
+            with self.fs_lock:
+                stats[outcome] += 1
+            self.metrics.resource_done(url, outcome, course)
+            return outcome
+
+        def produce():
+            for task in tasks:
+                self.metrics.add_files(1)
+                yield task
+
+        try:
+            results = pipeline_map(fetch, produce(), self.jobs,
+                                   self.queue_size)
+        finally:
+            for renderer in self.metrics.renderers:
+                renderer.clear()
+
+        stats['resources'] = [
+            {'url': url, 'target_dir': target_dir, 'fname': tfname,
+             'outcome': outcome}
+            for (url, target_dir, tfname), outcome in results]
+        return stats
+
+    def lecture_dirs(self, weeklyTopics, course_dir):
+        """
+        Create the week and lecture directories of a course, skipping the
+        weeks not in the week filter, and return the lecture directories.
+        """
+        dirs = []
+        for j, (weeklyTopic, weekClasses) in enumerate(weeklyTopics, start=1):
+            if self.wk_filter and j not in self.wk_filter:
+                print_(" - skipping %s (idx = %s), as it is not in the week filter" %
+                       (weeklyTopic, j))
+                continue
+            print_(" - " + weeklyTopic)
+            for i, (className, _) in enumerate(weekClasses, start=1):
+                clsdir = lecture_dir(course_dir, j, weeklyTopic, i, className)
+                if not path.exists(clsdir):
+                    os.makedirs(clsdir)
+                dirs.append(clsdir)
+        return dirs
+
+    def course_tasks(self, weeklyTopics, course_dir, create_dirs=True):
+        """
+        Turn the downloadable content of a course into a list of
+        (url, target_dir, target_fname) tuples for download_resources, skipping
+        the weeks not in the week filter. The week and class directories are
+        created unless create_dirs is False.
+        """
+        tasks = []
+        for j, (weeklyTopic, weekClasses) in enumerate(weeklyTopics, start=1):
+
+            if self.wk_filter and j not in self.wk_filter:
+                print_(" - skipping %s (idx = %s), as it is not in the week filter" %
+                       (weeklyTopic, j))
+                continue
+
+            print_(" - " + weeklyTopic)
+
+            for i, (className, classResources) in enumerate(weekClasses, start=1):
+
+                # ensure the class dir exists
+                clsdir = lecture_dir(course_dir, j, weeklyTopic, i, className)
+                if create_dirs and not path.exists(clsdir):
+                    os.makedirs(clsdir)
+
+                for classResource, tfname in classResources:
+                    tasks.append((classResource, clsdir, tfname))
+
+        return tasks
+
+    def download_course(self, cname, dest_dir=".", reverse_sections=False, gzip_courses=False,
+                        archive_format=None):
         """
         Download all the contents (quizzes, videos, lecture notes, ...)
         of the course to the given destination directory (defaults to .)
+        If an archive format (see ARCHIVE_FORMATS) is given, or gzip_courses
+        is set, the files are streamed into a tarball as they complete and
+        the course directory is removed afterwards.
+        Returns the outcomes of the resources as returned by
+        download_resources, together with the course summary of the metrics
+        (under 'summary'), or None if the course has no downloadable content.
         """
+        started = time.time()
+        self.local.course = cname
+
         # get the lecture url
         course_url = self.lecture_url_from_name(cname)
 
-        weeklyTopics = self.get_downloadable_content(course_url)
+        # the structure of the course is known once the lecture index is
+        # parsed, the videos missing from it are looked up on their lecture
+        # pages while the downloads are already under way
+        weeklyTopics = self.load_cached_content(cname)
+        missing = []
+        scraped = weeklyTopics is None
+        if scraped:
+            print_("* Collecting downloadable content from " + course_url)
+            weeklyTopics, missing = self.parse_lecture_index(
+                self.get_page(course_url))
 
         if not weeklyTopics:
             print_(" Warning: no downloadable content found for %s, did you accept the honour code?" %
                    cname)
-            return
+            return None
         else:
-            print_('* Got all downloadable content for ' + cname)
+            print_('* Got the structure of ' + cname)
 
+        # reverse a copy, the lecture lists are shared so the videos found
+        # still end up in weeklyTopics, which is cached in the original order
+        topics = weeklyTopics
         if reverse_sections:
-            weeklyTopics.reverse()
+            topics = weeklyTopics[::-1]
             print_("* Weekly modules reversed")
 
         # where the course will be downloaded to
@@ -419,63 +1464,597 @@ class CourseraDownloader(object):
 
         print_("* " + cname + " will be downloaded to " + course_dir)
 
-        # download the standard pages
+        # what got downloaded correctly on previous runs
+        manifest = DownloadManifest(course_dir)
+
+        if gzip_courses and not archive_format:
+            archive_format = 'gz'
+        archive = None
+        if archive_format:
+            archive = CourseArchive(course_dir, dest_dir, archive_format)
+            print_("* Files will be moved into " + archive.filename +
+                   " as they complete")
+
+        # download the standard pages, never from the content store
+        # in sync mode these are tracked in the manifest and revalidated
         print_(" - Downloading lecture/syllabus pages")
-        self.download(self.HOME_URL %
-                      cname, target_dir=course_dir, target_fname="index.html")
-        self.download(course_url,
-                      target_dir=course_dir, target_fname="lectures.html")
+        page_manifest = manifest if self.sync else None
+        self.download(self.HOME_URL % cname, target_dir=course_dir,
+                      target_fname="index.html", manifest=page_manifest,
+                      revalidate=True, use_store=False)
+        self.download(course_url, target_dir=course_dir,
+                      target_fname="lectures.html", manifest=page_manifest,
+                      revalidate=True, use_store=False)
         try:
             self.download_about(cname, course_dir)
         except Exception as e:
             print_("Warning: failed to download about file", e)
 
-        # now download the actual content (video's, lecture notes, ...)
-        for j, (weeklyTopic, weekClasses) in enumerate(weeklyTopics, start=1):
+        # create the directories up front so the workers never race on them
+        self.lecture_dirs(topics, course_dir)
+
+        # files of earlier runs are looked up by name across the whole
+        # course, so renamed lectures and renumbered weeks are not downloaded
+        # again
+        renames = RenameIndex(course_dir, layout_dirs(topics, course_dir))
+
+        def tasks():
+            for r in self.resolve_resources(topics, missing):
+                yield (r.url, lecture_dir(course_dir, r.week, r.week_topic,
+                                          r.lecture, r.lecture_name), r.fname)
+
+        # now download the actual content (video's, lecture notes, ...) as it
+        # is found
+        stats = self.download_resources(tasks(), manifest, archive, cname,
+                                        renames)
+        manifest.compact()
+
+        # the videos of the weeks skipped by the week filter were not looked
+        # up, such a course structure is incomplete
+        if scraped and not (missing and self.wk_filter):
+            self.save_cached_content(cname, weeklyTopics)
+
+        if archive:
+            print_("Adding the remaining files to " + archive.filename)
+            archive.close()
+            print_("Archive complete, course directory removed.")
+
+        print_("* Finished " + cname)
+        stats['summary'] = self.metrics.summary(
+            cname, started, dict((outcome, stats[outcome])
+                                 for outcome in (DOWNLOADED, SKIPPED, FAILED)
+                                 if stats[outcome]))
+        for line in format_summary(stats['summary']):
+            print_("   " + line)
+
+        return stats
+
+    def export_course(self, cname, queue, reverse_sections=False):
+        """
+        Add the pages and resources of a course to a work queue (see
+        WorkQueue) for workers to download with drain_queue, possibly on
+        other machines. Returns the number of items added, or None if the
+        course has no downloadable content.
+        """
+        weeklyTopics = self.get_cached_content(cname)
+        if not weeklyTopics:
+            print_(" Warning: no downloadable content found for %s, did you accept the honour code?" %
+                   cname)
+            return None
 
-            if self.wk_filter and j not in self.wk_filter:
-                print_(" - skipping %s (idx = %s), as it is not in the week filter" %
-                       (weeklyTopic, j))
+        if reverse_sections:
+            weeklyTopics.reverse()
+
+        # the directories are relative to the course directory, workers may
+        # have the destination mounted in different places
+        items = [
+            {'url': self.HOME_URL % cname, 'dir': '', 'fname': 'index.html',
+             'store': False, 'page': True},
+            {'url': self.lecture_url_from_name(cname), 'dir': '',
+             'fname': 'lectures.html', 'store': False, 'page': True},
+            {'url': self.ABOUT_URL % re.split('(-[0-9]+)', cname)[0],
+             'dir': '', 'fname': cname + '-about.json', 'about': True},
+        ]
+        for url, target_dir, tfname in self.course_tasks(weeklyTopics, '',
+                                                         create_dirs=False):
+            items.append({'url': url, 'dir': target_dir, 'fname': tfname,
+                          'store': True})
+        return queue.add(cname, items)
+
+    def drain_queue(self, queue, dest_dir=".", courses=None):
+        """
+        Work on a work queue filled by export_course: claim the items of the
+        given courses (by default all of them) and download them to their
+        course directories below dest_dir, using self.jobs parallel workers,
+        until no items are left. The outcome of every item is recorded in
+        the queue. Downloads are recorded in the manifest of their course,
+        as download_course does. Returns the number of items downloaded,
+        skipped and failed.
+        """
+        stats = dict((outcome, 0) for outcome in (DOWNLOADED, SKIPPED, FAILED))
+        self.metrics.add_files(queue.counts(courses)[TODO])
+        manifests = {}
+
+        def course_manifest(course):
+            with self.fs_lock:
+                if course not in manifests:
+                    course_dir = path.join(dest_dir, course)
+                    if not path.isdir(course_dir):
+                        try:
+                            os.makedirs(course_dir)
+                        except OSError:
+                            if not path.isdir(course_dir):
+                                raise
+                    manifests[course] = DownloadManifest(course_dir)
+                return manifests[course]
+
+        def work(_):
+            while True:
+                item = queue.claim(courses)
+                if item is None:
+                    return
+                self.local.course = item['course']
+                target_dir = path.join(dest_dir, item['course'], item['dir'])
+                try:
+                    # other workers may be creating the same directories
+                    if not path.isdir(target_dir):
+                        try:
+                            os.makedirs(target_dir)
+                        except OSError:
+                            if not path.isdir(target_dir):
+                                raise
+                    if item.get('about'):
+                        self.download_about(item['course'], target_dir)
+                        outcome = DOWNLOADED
+                    else:
+                        # pages are only tracked in sync mode, see
+                        # download_course
+                        page = item.get('page', False)
+                        manifest = course_manifest(item['course'])
+                        outcome = self.download(
+                            item['url'], target_dir=target_dir,
+                            target_fname=item['fname'],
+                            manifest=None if page and not self.sync else manifest,
+                            revalidate=page,
+                            use_store=item.get('store', True))
+                except Exception as e:
+                    print_("    - failed: ", item['url'], e)
+                    self.metrics.error(item['url'], e)
+                    outcome = FAILED
+                queue.complete(item, outcome, failed=outcome == FAILED)
+                with self.fs_lock:
+                    stats[outcome] += 1
+                self.metrics.resource_done(item['url'], outcome, item['course'])
+
+        try:
+            errors = [r for r in parallel_map(work, range(self.jobs), self.jobs)
+                      if isinstance(r, Exception)]
+        finally:
+            for renderer in self.metrics.renderers:
+                renderer.clear()
+        if errors:
+            raise errors[0]
+        return stats
+
+    def verify_course(self, cname, dest_dir=".", reverse_sections=False,
+                      repair=True):
+        """
+        Verify the files of a course downloaded earlier, to its course
+        directory or to a tarball (see ARCHIVE_FORMATS), and unless repair is
+        False download the broken ones again. Files are checked against their
+        manifest entry (size and checksum) or else the size of the resource
+        on the server, and videos must be complete mp4 files. Returns a dict
+        with the number of files per outcome (see verify.py) and under
+        'files' the path, outcome and problem of every file, or None if the
+        course was not found.
+        """
+        self.local.course = cname
+        course_dir = path.abspath(path.join(dest_dir, cname))
+        if path.isdir(course_dir):
+            return self.verify_dir(cname, course_dir, reverse_sections, repair)
+        for fmt, (_, ext) in sorted(ARCHIVE_FORMATS.items()):
+            tarball = course_dir + ext
+            if path.exists(tarball):
+                return self.verify_archive(cname, course_dir, tarball, fmt,
+                                           reverse_sections, repair)
+        print_(" Warning: %s not found in %s" % (cname, dest_dir))
+        return None
+
+    def resource_urls(self, cname, course_dir, reverse_sections=False):
+        """
+        Map the paths the resources of a course are downloaded to onto their
+        urls, as far as they can be told from the course structure: the name
+        of a resource that is only known from the server is taken to be the
+        last part of its url. The course pages are left out, they change
+        with every visit.
+        """
+        urls = {}
+        try:
+            weeklyTopics = self.get_cached_content(cname)
+        except Exception as e:
+            print_(" Warning: could not get the structure of %s: %s" % (cname, e))
+            return urls
+        if reverse_sections:
+            weeklyTopics = weeklyTopics[::-1]
+        for url, target_dir, tfname in self.course_tasks(weeklyTopics, course_dir,
+                                                         create_dirs=False):
+            urls[path.join(target_dir, tfname or filename_from_url(url))] = url
+        return urls
+
+    def server_size(self, url):
+        """
+        Size of the resource at url, from a request for its first byte. -1
+        if the server does not tell.
+        """
+        with self.connection_slots():
+            response = self.get_response(url, stream=True,
+                                         headers={'Range': 'bytes=0-0'})
+            self.release_response(response)
+        return full_content_length(response)
+
+    def check_file(self, f, size, name, entry=None, url=None):
+        """
+        Check a file (object) of the given size and name, see file_problem.
+        Without a manifest entry the size is compared with what the server
+        has at url, if known. Returns the problem, or None, whether the file
+        could be checked at all and the size it should have (-1 if not
+        known).
+        """
+        clen = self.server_size(url) if not entry and url else -1
+        is_mp4 = name.lower().endswith('.mp4')
+        problem = file_problem(f, size, entry, clen, is_mp4)
+        expected = entry['size'] if entry else clen
+        return problem, bool(entry or clen > 0 or is_mp4), expected
+
+    def verify_dir(self, cname, course_dir, reverse_sections=False,
+                   repair=True):
+        """
+        verify_course for a course directory, the files are checked in
+        parallel.
+        """
+        manifest = DownloadManifest(course_dir)
+        entries = dict((path.normpath(manifest.abspath(e)), e)
+                       for e in manifest.entries.values())
+        urls = self.resource_urls(cname, course_dir, reverse_sections)
+        urls.update((p, e['url']) for p, e in entries.items())
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(course_dir):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.startswith('.') or fn.endswith((PART_EXT, SEGMENT_EXT)):
+                    continue
+                files.append(path.join(dirpath, fn))
+
+        print_(" - Verifying %d files using %d worker(s)" %
+               (len(files), self.jobs))
+
+        def verify(filepath):
+            name = path.relpath(filepath, course_dir)
+            entry = entries.get(filepath)
+            url = urls.get(filepath)
+            size = path.getsize(filepath)
+            with open(filepath, 'rb') as f:
+                problem, checked, expected = self.check_file(
+                    f, size, filepath, entry, url)
+            if not problem:
+                return {'path': name, 'outcome': OK if checked else UNVERIFIED,
+                        'problem': None}
+
+            print_('    - "%s" is broken: %s' % (name, problem))
+            outcome = BROKEN
+            # a file that is only short is resumed from what it has
+            if repair and url and self.repair_file(
+                    url, filepath, manifest, size < expected) == DOWNLOADED:
+                # the server may well have sent the same broken file
+                entry = manifest.entries.get(url)
+                with open(filepath, 'rb') as f:
+                    if not self.check_file(f, path.getsize(filepath),
+                                           filepath, entry, url)[0]:
+                        outcome = REPAIRED
+            return {'path': name, 'outcome': outcome, 'problem': problem}
+
+        results = []
+        for filepath, result in zip(files, parallel_map(verify, files, self.jobs)):
+            if isinstance(result, Exception):
+                print_('    - could not verify "%s": %s' % (filepath, result))
+                result = {'path': path.relpath(filepath, course_dir),
+                          'outcome': UNVERIFIED, 'problem': str(result)}
+            results.append(result)
+        if path.exists(manifest.filename):
+            manifest.compact()
+        return verify_stats(results)
+
+    def repair_file(self, url, filepath, manifest=None, resume=False):
+        """
+        Download a broken file again, resuming from its content if resume is
+        set. Returns the outcome of the download.
+        """
+        partpath = filepath + PART_EXT
+        if resume:
+            replace_file(filepath, partpath)
+        else:
+            os.remove(filepath)
+            if path.exists(partpath):
+                os.remove(partpath)
+        # the store is bypassed, the broken file may have come from there
+        return self.download(url, target_dir=path.dirname(filepath),
+                             target_fname=path.basename(filepath),
+                             manifest=manifest, use_store=False)
+
+    def verify_archive(self, cname, course_dir, tarball, fmt,
+                       reverse_sections=False, repair=True):
+        """
+        verify_course for a course tarball. A compressed tarball can only be
+        read front to back cheaply, so it is read as a stream, once to check
+        the members (see scan_file) and, if any were repaired, once more to
+        rewrite it with the files downloaded again to the course directory.
+        """
+        arcroot = path.basename(course_dir)
+        manifest_name = path.join(arcroot, MANIFEST_NAME)
+        urls = self.resource_urls(cname, course_dir, reverse_sections)
+
+        print_(" - Verifying %s" % tarball)
+        scans = []
+        manifest_data = None
+        with tarfile.open(tarball, 'r|*') as tar:
+            for m in tar:
+                if not m.isfile():
+                    continue
+                if m.name == manifest_name:
+                    manifest_data = tar.extractfile(m).read()
+                    continue
+                is_mp4 = m.name.lower().endswith('.mp4')
+                sha1, mp4 = scan_file(tar.extractfile(m), m.size, True, is_mp4)
+                scans.append((m.name, m.size, sha1, mp4, is_mp4))
+
+        entries = {}
+        for line in (manifest_data or b'').decode('utf-8').splitlines():
+            try:
+                entry = json.loads(line)
+                entries[path.normpath(entry['path'])] = entry
+            except (ValueError, KeyError):
                 continue
 
-            # add a numeric prefix to the week directory name to ensure
-            # chronological ordering
-            wkdirname = str(j).zfill(2) + " - " + weeklyTopic
+        def judge(scan):
+            arcname, size, sha1, mp4, is_mp4 = scan
+            name = path.relpath(arcname, arcroot)
+            entry = entries.get(path.normpath(name))
+            url = entry['url'] if entry else urls.get(path.join(course_dir, name))
+            clen = self.server_size(url) if not entry and url else -1
+            problem = scan_problem(size, sha1, mp4, entry, clen)
+            if not problem:
+                checked = bool(entry or clen > 0 or is_mp4)
+                return {'path': name, 'outcome': OK if checked else UNVERIFIED,
+                        'problem': None}, None
+            print_('    - "%s" is broken: %s' % (name, problem))
+            return {'path': name, 'outcome': BROKEN, 'problem': problem}, url
+
+        # the members without a manifest entry (all of them in a tarball of
+        # an older version) are compared with the server, in parallel
+        results = []
+        broken = {}
+        for scan, judged in zip(scans, parallel_map(judge, scans, self.jobs)):
+            if isinstance(judged, Exception):
+                name = path.relpath(scan[0], arcroot)
+                print_('    - could not verify "%s": %s' % (name, judged))
+                results.append({'path': name, 'outcome': UNVERIFIED,
+                                'problem': str(judged)})
+                continue
+            result, url = judged
+            results.append(result)
+            if result['outcome'] == BROKEN and url:
+                broken[scan[0]] = url
 
-            # ensure the week dir exists
-            wkdir = path.join(course_dir, wkdirname)
-            if not path.exists(wkdir):
-                os.makedirs(wkdir)
+        if not (repair and broken):
+            return verify_stats(results)
 
-            print_(" - " + weeklyTopic)
+        # download the broken files to the course directory, with the
+        # manifest of the tarball to record them in
+        os.makedirs(course_dir)
+        try:
+            if manifest_data is not None:
+                with open(path.join(course_dir, MANIFEST_NAME), 'wb') as f:
+                    f.write(manifest_data)
+            manifest = DownloadManifest(course_dir)
+            repaired = []
+            for arcname, url in sorted(broken.items()):
+                filepath = path.join(course_dir, path.relpath(arcname, arcroot))
+                if not path.exists(path.dirname(filepath)):
+                    os.makedirs(path.dirname(filepath))
+                if self.download(url, target_dir=path.dirname(filepath),
+                                 target_fname=path.basename(filepath),
+                                 manifest=manifest,
+                                 use_store=False) == DOWNLOADED:
+                    repaired.append(arcname)
+            manifest.compact()
+
+            # copy the tarball, replacing the repaired files and the manifest
+            if repaired:
+                print_(" - Rewriting %s" % tarball)
+                compression = ARCHIVE_FORMATS[fmt][0]
+                with tarfile.open(tarball, 'r|*') as tar:
+                    with tarfile.open(tarball + '.tmp', 'w:' + compression) as out:
+                        for m in tar:
+                            if m.name in repaired or m.name == manifest_name:
+                                continue
+                            out.addfile(m, tar.extractfile(m) if m.isfile() else None)
+                        for arcname in repaired + [manifest_name]:
+                            out.add(path.join(course_dir, path.relpath(arcname, arcroot)),
+                                    arcname=arcname)
+        finally:
+            shutil.rmtree(course_dir)
+
+        if repaired:
+            replace_file(tarball + '.tmp', tarball)
+            for result in results:
+                if path.join(arcroot, result['path']) in repaired:
+                    result['outcome'] = REPAIRED
+        return verify_stats(results)
+
+    def plan_course(self, cname, dest_dir=".", reverse_sections=False):
+        """
+        Work out what download_course would do, without downloading
+        anything: the name, size and state on disk of every resource of the
+        course, the sizes coming from a request for the first byte of each
+        resource. Returns a dict with the course, its directory, the list of
+        resources (see plan_resource) and their totals (see plan_totals), or
+        None if the course has no downloadable content.
+        """
+        self.local.course = cname
 
-            for i, (className, classResources) in enumerate(weekClasses, start=1):
+        weeklyTopics = self.get_cached_content(cname)
+        if not weeklyTopics:
+            print_(" Warning: no downloadable content found for %s, did you accept the honour code?" %
+                   cname)
+            return None
 
-                # ensure chronological ordering
-                clsdirname = str(i).zfill(2) + " - " + className
+        if reverse_sections:
+            weeklyTopics.reverse()
 
-                # ensure the class dir exists
-                clsdir = path.join(wkdir, clsdirname)
-                if not path.exists(clsdir):
-                    os.makedirs(clsdir)
+        course_dir = path.abspath(path.join(dest_dir, cname))
+        tasks = self.course_tasks(weeklyTopics, course_dir, create_dirs=False)
+        manifest = DownloadManifest(course_dir)
+        renames = RenameIndex(course_dir, layout_dirs(weeklyTopics, course_dir))
 
-                print_("  - Downloading resources for " + className)
+        print_(" - Probing %d resources using %d worker(s)" %
+               (len(tasks), self.jobs))
 
-                # download each resource
-                for classResource, tfname in classResources:
-                    try:
-                        self.download(
-                            classResource, target_dir=clsdir, target_fname=tfname)
-                    except Exception as e:
-                        print_("    - failed: ", classResource, e)
-        if gzip_courses:
-            tar_file_name = cname + ".tar.gz"
-            print_("Compressing and storing as " + tar_file_name)
-            tar = tarfile.open(os.path.join(dest_dir, tar_file_name), 'w:gz')
-            tar.add(os.path.join(dest_dir, cname), arcname=cname)
-            tar.close()
-            print_("Compression complete. Cleaning up.")
-            shutil.rmtree(os.path.join(dest_dir, cname))
+        def plan(task):
+            return self.plan_resource(task, course_dir, manifest, renames)
+
+        files = []
+        for (url, _, _), item in zip(tasks, parallel_map(plan, tasks, self.jobs)):
+            if isinstance(item, Exception):
+                print_("    - failed to probe %s: %s" % (url, item))
+                item = {'url': url, 'path': None, 'size': None,
+                        'action': 'error', 'bytes': None, 'error': str(item)}
+            files.append(item)
+
+        return {'course': cname, 'course_dir': course_dir, 'files': files,
+                'totals': plan_totals(files)}
+
+    def plan_resource(self, task, course_dir, manifest=None, renames=None):
+        """
+        Plan the download of a (url, target_dir, target_fname) task. Returns
+        a dict holding the url, the path of the file relative to the course
+        directory, its size (None if unknown), the number of bytes that need
+        to be transferred and the action download() would take:
+
+            download   the file is not on disk yet
+            resume     part of the file is on disk
+            skip       the file is already downloaded
+            rename     the file is on disk under another name ('from')
+            link       the file is in the content store
+            ignore     the extension of the file is ignored
+        """
+        url, target_dir, target_fname = task
+        url = url.replace("_fr&format=", "_en&format=")
+
+        def item(filepath, size, action, nbytes=0, **extra):
+            extra.update(url=url, path=path.relpath(filepath, course_dir),
+                         size=size, action=action, bytes=nbytes)
+            return extra
+
+        # what is known without asking the server
+        if manifest:
+            entry = manifest.get(url)
+            if entry and self.manifest_entry_matches(manifest, entry,
+                                                     target_dir, target_fname):
+                return item(manifest.abspath(entry), entry['size'], 'skip')
+        if self.store:
+            entry = self.store.lookup(url)
+            if entry:
+                return item(path.join(target_dir, target_fname or entry['name']),
+                            entry['size'], 'link')
+
+        # the headers of a one byte ranged request give the name and full
+        # size of the resource, servers that ignore the range send it all
+        with self.connection_slots():
+            response = self.get_response(url, stream=True,
+                                         headers={'Range': 'bytes=0-0'})
+            self.release_response(response)
+        clen = full_content_length(response)
+        size = clen if clen > 0 else None
+
+        fname = target_fname or filename_from_header(
+            response.headers) or filename_from_url(url)
+        filepath = path.join(target_dir, fname)
+
+        _, ext = path.splitext(fname)
+        if ext and ext[1:] in self.ignorefiles:
+            return item(filepath, size, 'ignore')
+
+        # the same decisions as should_download, without touching the files
+        partsize = partial_size(filepath)
+        if path.exists(filepath):
+            fs = path.getsize(filepath)
+            if size and size - fs > 2:
+                return item(filepath, size, 'resume',
+                            size - max(fs, partsize))
+            return item(filepath, size, 'skip')
+        if size and renames:
+            existing = renames.find(filepath, size)
+            if existing:
+                return item(filepath, size, 'rename',
+                            **{'from': path.relpath(existing, course_dir)})
+        if partsize and size and partsize < size:
+            return item(filepath, size, 'resume', size - partsize)
+        return item(filepath, size, 'download', size)
+
+
+def verify_stats(results):
+    """
+    Count the outcomes of a list of verified files, the list is kept under
+    'files'.
+    """
+    stats = dict((outcome, 0) for outcome in (OK, BROKEN, REPAIRED, UNVERIFIED))
+    for result in results:
+        stats[result['outcome']] += 1
+    stats['files'] = results
+    return stats
+
+
+def plan_totals(files):
+    """
+    Totals of a list of planned resources (see plan_resource): the number
+    of files per action, the size of all the files that are not ignored,
+    the files and bytes to transfer and the number of files of unknown size.
+    """
+    actions = {}
+    for f in files:
+        actions[f['action']] = actions.get(f['action'], 0) + 1
+    wanted = [f for f in files if f['action'] not in ('ignore', 'error')]
+    transfers = [f for f in files if f['action'] in ('download', 'resume')]
+    return {
+        'files': len(wanted),
+        'bytes': sum(f['size'] or 0 for f in wanted),
+        'actions': actions,
+        'transfer_files': len(transfers),
+        'transfer_bytes': sum(f['bytes'] or 0 for f in transfers),
+        'unknown_size': len([f for f in wanted if f['size'] is None]),
+    }
+
+
+def lecture_dir(course_dir, week, week_topic, lecture, lecture_name):
+    """
+    The directory the resources of a lecture go to, e.g., for a Resource r:
+    lecture_dir(course_dir, r.week, r.week_topic, r.lecture, r.lecture_name).
+    The weeks and lectures get a numeric prefix to keep them in order.
+    """
+    return path.join(course_dir, str(week).zfill(2) + " - " + week_topic,
+                     str(lecture).zfill(2) + " - " + lecture_name)
+
+
+def layout_dirs(weeklyTopics, course_dir):
+    """
+    All the lecture directories of a course layout, including those of
+    the weeks left out by a week filter: they are still part of the layout
+    and their files must not be taken for renamed copies.
+    """
+    return [lecture_dir(course_dir, j, weeklyTopic, i, className)
+            for j, (weeklyTopic, weekClasses) in enumerate(weeklyTopics, start=1)
+            for i, (className, _) in enumerate(weekClasses, start=1)]
 
 
 def get_netrc_creds():
@@ -517,31 +2096,6 @@ def get_netrc_creds():
     return creds
 
 
-def normalize_string(str):
-    return ''.join(x for x in str if x not in ' \t-_()"01234567890').lower()
-
-
-def find_renamed(filename, size):
-    fpath, name = path.split(filename)
-    name, ext = path.splitext(name)
-    name = normalize_string(name)
-
-    if not path.exists(fpath):
-        return None, None
-
-    files = os.listdir(fpath)
-    if files:
-        for f in files:
-            fname, fext = path.splitext(f)
-            fname = normalize_string(fname)
-            if fname == name and fext == ext:
-                fullname = os.path.join(fpath, f)
-                if path.getsize(fullname) == size:
-                    return fullname, f
-
-    return None, None
-
-
 def main():
     # parse the commandline arguments
     parser = argparse.ArgumentParser(
@@ -566,10 +2120,64 @@ def main():
                         type=str, help='one or more course names from the url (e.g., comnets-2012-001)')
     parser.add_argument("--gz",
                         dest='gzip_courses', action="store_true", default=False, help='Tarball courses for archival storage (folders get deleted)')
+    parser.add_argument("--archive", dest='archive_format', choices=sorted(ARCHIVE_FORMATS), default=None,
+                        help='like --gz but with the given compression, "tar" (none) is fastest for video courses')
     parser.add_argument("-mppl", dest='mppl', type=int, default=100,
                         help='Maximum length of filenames/dirs in a path (windows only)')
     parser.add_argument("-w", dest='wkfilter', type=str, default=None,
                         help="Comma separted list of week numbers to download e.g., 1,3,8")
+    parser.add_argument("-j", "--jobs", dest='jobs', type=int, default=1,
+                        help="number of files to download in parallel")
+    parser.add_argument("--queue-size", dest='queue_size', type=int, default=None,
+                        help="number of resources found while scraping that may wait for a worker (default: twice --jobs)")
+    parser.add_argument("--no-fsync", dest='fsync', action="store_false", default=True,
+                        help="do not wait for downloaded files to be written to disk (faster, but a crash may leave corrupt files)")
+    parser.add_argument("--parallel-courses", dest='parallel_courses', type=int, default=1,
+                        help="number of courses to download at the same time")
+    parser.add_argument("--max-connections", dest='max_connections', type=int, default=None,
+                        help="maximum number of concurrent connections across all courses")
+    parser.add_argument("--limit-rate", dest='limit_rate', type=parse_size, default=None,
+                        help="maximum total download speed in bytes per second, e.g., 500K or 2M")
+    parser.add_argument("--max-requests", dest='max_requests', type=float, default=None,
+                        help="maximum number of requests per second made to coursera")
+    parser.add_argument("--retries", dest='retries', type=int, default=3,
+                        help="how often to retry a failed request or interrupted download (default: 3)")
+    parser.add_argument("--pool-size", dest='pool_size', type=int, default=None,
+                        help="number of connections kept alive per host (default: enough for all workers)")
+    parser.add_argument("--progress", dest='progress', choices=['auto', 'bar', 'none'], default='auto',
+                        help="show a status line while downloading (auto: only on a terminal)")
+    parser.add_argument("--metrics-file", dest='metrics_file', type=str, default=None,
+                        help="append per-file and per-course metrics to this file as JSON lines")
+    parser.add_argument("--segments", dest='segments', type=int, default=1,
+                        help="number of parallel connections used to download large files (if the server supports ranges)")
+    parser.add_argument("--sync", dest='sync', action="store_true", default=False,
+                        help="incremental sync: revalidate pages with conditional requests (ETag/If-Modified-Since) rather than downloading them again")
+    parser.add_argument("--refresh", dest='refresh', action="store_true", default=False,
+                        help="scrape the course structure again even if a cached copy is recent enough")
+    parser.add_argument("--cache-ttl", dest='cache_ttl', type=float, default=24,
+                        help="hours the scraped course structure is reused for, 0 disables the cache (default: 24)")
+    parser.add_argument("--cache-dir", dest='cache_dir', type=str, default=None,
+                        help="directory where state is kept between runs (default: ~/.coursera-dl)")
+    parser.add_argument("--verify", dest='verify', action="store_true", default=False,
+                        help="verify the files of courses downloaded earlier (to a directory or tarball) and download the broken ones again")
+    parser.add_argument("--no-repair", dest='repair', action="store_false", default=True,
+                        help="with --verify, only report the broken files")
+    parser.add_argument("--plan", dest='plan_file', type=str, default=None,
+                        help="do not download anything, write the download plan (files, sizes and what is already on disk) to this file as json")
+    parser.add_argument("--export-queue", dest='export_queue', type=str, default=None,
+                        help="do not download anything, add the resources of the courses to a work queue in this directory for --worker to download")
+    parser.add_argument("--worker", dest='worker_queue', type=str, default=None,
+                        help="download the resources of the courses from the work queue in this directory, together with any other workers using it")
+    parser.add_argument("--worker-id", dest='worker_id', type=str, default=None,
+                        help="name of this worker in the work queue (default: hostname-pid)")
+    parser.add_argument("--requeue-after", dest='requeue_after', type=float, default=None,
+                        help="with --worker, first put back failed items and items claimed more than this many seconds ago by workers that died")
+    parser.add_argument("--fresh-login", dest='fresh_login', action="store_true", default=False,
+                        help="log in even if the session of an earlier run is still valid")
+    parser.add_argument("--no-session-cache", dest='session_cache', action="store_false", default=True,
+                        help="do not keep the session cookies between runs")
+    parser.add_argument("--store", dest='store_dir', type=str, default=None,
+                        help="content addressed store shared by all courses: files are kept once and hard linked into the courses, resources already in the store are not downloaded again")
     args = parser.parse_args()
 
     # check the parser
@@ -607,27 +2215,162 @@ def main():
             pass
 
     # instantiate the downloader class
-    d = CourseraDownloader(
-        username,
-        password,
-        proxy=args.proxy,
-        parser=html_parser,
-        ignorefiles=args.ignorefiles,
-        max_path_part_len=mppl,
-        gzip_courses=args.gzip_courses,
-        wk_filter=args.wkfilter
-    )
+    try:
+        d = CourseraDownloader(
+            username,
+            password,
+            proxy=args.proxy,
+            parser=html_parser,
+            ignorefiles=args.ignorefiles,
+            max_path_part_len=mppl,
+            gzip_courses=args.gzip_courses,
+            wk_filter=args.wkfilter,
+            jobs=args.jobs,
+            sync=args.sync,
+            cache_dir=args.cache_dir,
+            segments=args.segments,
+            content_ttl=args.cache_ttl * 3600,
+            refresh=args.refresh,
+            max_connections=args.max_connections,
+            limit_rate=args.limit_rate,
+            max_requests=args.max_requests,
+            retries=args.retries,
+            pool_maxsize=args.pool_size or args.max_connections or
+            args.jobs * max(1, args.segments) * max(1, args.parallel_courses),
+            progress=args.progress,
+            metrics_file=args.metrics_file,
+            store_dir=args.store_dir,
+            session_cache=args.session_cache,
+            queue_size=args.queue_size,
+            fsync=args.fsync
+        )
+    except ValueError as e:
+        parser.error(str(e))
 
     # authenticate, only need to do this once but need a classaname to get hold
     # of the csrf token, so simply pass the first one
     print_("Logging in as '%s'..." % username)
-    d.login(args.course_names[0])
-
-    # download the content
-    for i, cn in enumerate(args.course_names, start=1):
+    d.login(args.course_names[0], reuse=not args.fresh_login)
+
+    if args.plan_file:
+        def plan_course(cn):
+            print_("\nPlanning %s" % cn)
+            return d.plan_course(cn, dest_dir=args.dest_dir,
+                                 reverse_sections=args.reverse)
+
+        plans = []
+        failed = False
+        for cn, plan in zip(args.course_names,
+                            parallel_map(plan_course, args.course_names,
+                                         args.parallel_courses)):
+            if isinstance(plan, Exception):
+                print_(" - %s: failed (%s)" % (cn, plan))
+                plan = {'course': cn, 'error': str(plan)}
+                failed = True
+            elif plan is None:
+                plan = {'course': cn, 'files': [], 'totals': plan_totals([])}
+            plans.append(plan)
+
+        totals = plan_totals([f for p in plans for f in p.get('files', [])])
+        with open(args.plan_file, 'w') as f:
+            json.dump({'courses': plans, 'totals': totals}, f, indent=2,
+                      sort_keys=True)
+        print_("\nPlan written to %s: %d files, %s to transfer in %d files" %
+               (args.plan_file, totals['files'],
+                format_bytes(totals['transfer_bytes']),
+                totals['transfer_files']))
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.verify:
+        def verify_course(cn):
+            print_("\nVerifying %s" % cn)
+            return d.verify_course(cn, dest_dir=args.dest_dir,
+                                   reverse_sections=args.reverse,
+                                   repair=args.repair)
+
+        print_("\nVerification:")
+        # broken files that were not (or could not be) repaired fail the run
+        failed = False
+        for cn, stats in zip(args.course_names,
+                             parallel_map(verify_course, args.course_names,
+                                          args.parallel_courses)):
+            if isinstance(stats, Exception):
+                print_(" - %s: failed (%s)" % (cn, stats))
+                failed = True
+            elif stats is None:
+                print_(" - %s: not found" % cn)
+            else:
+                print_(" - %s: %d ok, %d broken, %d repaired, %d unverified" %
+                       (cn, stats[OK], stats[BROKEN], stats[REPAIRED],
+                        stats[UNVERIFIED]))
+                failed = failed or stats[BROKEN] > 0
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.export_queue:
+        queue = WorkQueue(args.export_queue)
+        for cn in args.course_names:
+            try:
+                n = d.export_course(cn, queue, reverse_sections=args.reverse)
+                print_(" - %s: %d items queued" % (cn, n or 0))
+            except ValueError as e:
+                print_(" - %s: %s" % (cn, e))
+        return
+
+    if args.worker_queue:
+        queue = WorkQueue(args.worker_queue, args.worker_id)
+        if args.requeue_after is not None:
+            n = queue.requeue_stale(args.requeue_after, args.course_names)
+            print_("Requeued %d stale or failed items" % n)
+        print_("Working on %s as %s" % (args.worker_queue, queue.worker_id))
+        stats = d.drain_queue(queue, args.dest_dir, args.course_names)
+        print_("Worker %s: downloaded %d, skipped %d, failed %d" %
+               (queue.worker_id, stats[DOWNLOADED], stats[SKIPPED],
+                stats[FAILED]))
+        counts = queue.counts(args.course_names)
+        print_("Queue: %d to do, %d claimed, %d done, %d failed" %
+               (counts['todo'], counts['claimed'], counts['done'],
+                counts['failed']))
+        return
+
+    # download the content, several courses at a time if requested
+    def download_course(course):
+        i, cn = course
         print_("\nCourse %s of %s" % (i, len(args.course_names)))
-        d.download_course(cn, dest_dir=args.dest_dir,
-                          reverse_sections=args.reverse, gzip_courses=args.gzip_courses)
+        return d.download_course(cn, dest_dir=args.dest_dir,
+                                 reverse_sections=args.reverse, gzip_courses=args.gzip_courses,
+                                 archive_format=args.archive_format)
+
+    results = parallel_map(download_course,
+                           enumerate(args.course_names, start=1),
+                           args.parallel_courses)
+
+    failures = [(cn, stats) for cn, stats in zip(args.course_names, results)
+                if isinstance(stats, Exception)]
+    if len(args.course_names) == 1:
+        for cn, e in failures:
+            print_("\n%s failed: %s" % (cn, e))
+    else:
+        print_("\nSummary:")
+        for cn, stats in zip(args.course_names, results):
+            if isinstance(stats, Exception):
+                print_(" - %s: failed (%s)" % (cn, stats))
+            elif stats is None:
+                print_(" - %s: no downloadable content" % cn)
+            else:
+                print_(" - %s: downloaded %d, skipped %d, failed %d" %
+                       (cn, stats[DOWNLOADED], stats[SKIPPED], stats[FAILED]))
+        print_("Total:")
+        for line in format_summary(d.metrics.summary()):
+            print_(" " + line)
+
+    nrequests, nconnections = d.connection_stats()
+    print_("Made %d requests over %d connections" % (nrequests, nconnections))
+    if failures:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+from os import path
+from util import replace_file, validator_headers
+
+
+class HttpCache(object):
+
+    """
+    On-disk cache of pages together with the ETag/Last-Modified validators
+    the server sent for them, so they can be fetched again with a
+    conditional request and reused when the server answers 304.
+
+    Every url is stored as two files named after the sha1 of the url: the
+    body and a small json file with the validators.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _key(self, url):
+        return path.join(self.cache_dir,
+                         hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def validators(self, url):
+        """
+        Return the stored validators for url, an empty dict if there are
+        none or the cached body went missing.
+        """
+        key = self._key(url)
+        if not path.exists(key + '.body'):
+            return {}
+        try:
+            with open(key + '.json') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def conditional_headers(self, url):
+        """
+        Return the If-None-Match/If-Modified-Since headers to send for url.
+        """
+        return validator_headers(self.validators(url))
+
+    def get_body(self, url):
+        with open(self._key(url) + '.body', 'rb') as f:
+            return f.read()
+
+    def store(self, url, headers, body):
+        """
+        Store the body of a response for url, provided the server sent
+        validators to revalidate it with later.
+        """
+        entry = {'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified')}
+        if not entry['etag'] and not entry['last_modified']:
+            return
+
+        key = self._key(url)
+        with open(key + '.body.tmp', 'wb') as f:
+            f.write(body)
+        replace_file(key + '.body.tmp', key + '.body')
+        with open(key + '.json.tmp', 'w') as f:
+            json.dump(entry, f)
+        replace_file(key + '.json.tmp', key + '.json')
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import threading
+import time
+from os import path
+from util import replace_file
+
+# name of the manifest file kept in each course directory
+MANIFEST_NAME = '.coursera-dl-manifest.jsonl'
+
+
+def file_checksum(filename, hasher=None, bufsize=1048576):
+    """
+    Return the sha1 hex digest of the given file. If a hasher is passed it
+    is updated with the file content and returned instead.
+    """
+    h = hasher or hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(bufsize)
+            if not data:
+                break
+            h.update(data)
+    return h if hasher else h.hexdigest()
+
+
+class DownloadManifest(object):
+
+    """
+    Record of the resources of a course that downloaded correctly, keyed by
+    resource url. It is stored as a JSON-lines file in the course directory,
+    one entry per line, later entries replacing earlier ones for the same url,
+    so recording a download is a cheap append.
+
+    Each entry holds the path of the file (relative to the course directory),
+    its size, its sha1 checksum and the ETag/Last-Modified validators the
+    server sent with it.
+    """
+
+    def __init__(self, course_dir):
+        self.course_dir = course_dir
+        self.filename = path.join(course_dir, MANIFEST_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['url']] = entry
+                except (ValueError, KeyError):
+                    # a line truncated by an interrupted run
+                    continue
+
+    def get(self, url):
+        """
+        Return the entry for url if the file it describes is still on disk
+        with the recorded size, None otherwise.
+        """
+        entry = self.entries.get(url)
+        if not entry:
+            return None
+        filepath = self.abspath(entry)
+        if not path.exists(filepath) or path.getsize(filepath) != entry['size']:
+            return None
+        return entry
+
+    def abspath(self, entry):
+        return path.join(self.course_dir, entry['path'])
+
+    def record(self, url, filepath, headers=None, checksum=None):
+        """
+        Record that url was downloaded correctly to filepath.
+        """
+        headers = headers or {}
+        entry = {
+            'url': url,
+            'path': path.relpath(filepath, self.course_dir),
+            'size': path.getsize(filepath),
+            'sha1': checksum or file_checksum(filepath),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'time': int(time.time()),
+        }
+        with self.lock:
+            self.entries[url] = entry
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
+
+    def compact(self):
+        """
+        Rewrite the manifest keeping only the latest entry for each url.
+        """
+        with self.lock:
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                for url in sorted(self.entries):
+                    f.write(json.dumps(self.entries[url], sort_keys=True) + '\n')
+            replace_file(tmpname, self.filename)
@@ -0,0 +1,353 @@
+import collections
+import json
+import sys
+import threading
+import time
+from util import format_bytes
+
+
+class RateMeter(object):
+
+    """
+    Moving average of a byte rate over the last 'window' seconds.
+    """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.samples = collections.deque()
+        self.total = 0
+
+    def add(self, nbytes, now=None):
+        now = now or time.time()
+        self.total += nbytes
+        self.samples.append((now, self.total))
+        while len(self.samples) > 2 and now - self.samples[1][0] > self.window:
+            self.samples.popleft()
+
+    def rate(self, now=None):
+        if len(self.samples) < 2:
+            return 0.0
+        now = now or time.time()
+        t0, b0 = self.samples[0]
+        elapsed = now - t0
+        return (self.total - b0) / elapsed if elapsed > 0 else 0.0
+
+
+class FileMetrics(object):
+
+    """
+    What happened while downloading one file.
+    """
+
+    def __init__(self, url, filepath, size, course=None, started=None):
+        self.url = url
+        self.filepath = filepath
+        self.size = size
+        self.course = course
+        self.started = started or time.time()
+        self.first_byte = None
+        self.finished = None
+        self.bytes = 0
+        self.retries = 0
+        self.outcome = None
+        self.meter = RateMeter()
+
+    def ttfb(self):
+        """Time to first byte in seconds, None if no data arrived"""
+        return self.first_byte - self.started if self.first_byte else None
+
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def as_dict(self):
+        duration = self.duration()
+        return {
+            'event': 'file',
+            'course': self.course,
+            'url': self.url,
+            'path': self.filepath,
+            'size': self.size,
+            'bytes': self.bytes,
+            'outcome': self.outcome,
+            'retries': self.retries,
+            'ttfb': self.ttfb(),
+            'duration': duration,
+            'throughput': self.bytes / duration if duration > 0 else 0.0,
+        }
+
+
+class DownloadMetrics(object):
+
+    """
+    Thread safe collector of per-file and aggregate download metrics: bytes,
+    moving average throughput, time to first byte, retries and the number of
+    resources downloaded, skipped and failed. Renderers (see StatusLine,
+    JsonLines and Hooks) are told about started files, progress, completed
+    files, errors, finished resources and summaries.
+    """
+
+    def __init__(self, renderers=None):
+        self.renderers = list(renderers or [])
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.total_files = 0
+        self.done_files = 0
+        self.active = set()
+        self.files = []
+        self.outcomes = collections.defaultdict(int)
+        self.course_outcomes = collections.defaultdict(
+            lambda: collections.defaultdict(int))
+        self.retries = 0
+        self.bytes = 0
+        self.meter = RateMeter()
+
+    def _notify(self, method, *args):
+        for renderer in self.renderers:
+            getattr(renderer, method)(self, *args)
+
+    def add_files(self, n):
+        with self.lock:
+            self.total_files += n
+
+    def start_file(self, url, filepath, size, course=None, started=None):
+        """
+        Start tracking the transfer of a file, returns its FileMetrics.
+        """
+        record = FileMetrics(url, filepath, size, course, started)
+        with self.lock:
+            self.active.add(record)
+            self._notify('file_start', record)
+        return record
+
+    def update(self, record, nbytes):
+        now = time.time()
+        with self.lock:
+            if record.first_byte is None:
+                record.first_byte = now
+            record.bytes += nbytes
+            record.meter.add(nbytes, now)
+            self.bytes += nbytes
+            self.meter.add(nbytes, now)
+            self._notify('progress', record, nbytes)
+
+    def retry(self, record=None):
+        with self.lock:
+            self.retries += 1
+            if record:
+                record.retries += 1
+
+    def finish_file(self, record, outcome):
+        with self.lock:
+            record.finished = time.time()
+            record.outcome = outcome
+            self.active.discard(record)
+            self.files.append(record)
+            self._notify('file_done', record)
+
+    def error(self, url, error, record=None):
+        """
+        Report that the resource at url failed, record is None if it failed
+        before its transfer started.
+        """
+        with self.lock:
+            self._notify('error', url, error, record)
+
+    def resource_done(self, url, outcome, course=None):
+        """
+        Count the resource at url, handed to the downloader, as downloaded,
+        skipped or failed. Unlike file_done this is reported for every
+        resource, including those that needed no transfer.
+        """
+        with self.lock:
+            self.done_files += 1
+            self.outcomes[outcome] += 1
+            self.course_outcomes[course][outcome] += 1
+            self._notify('resource_done', url, outcome, course)
+            self._notify('progress')
+
+    def rate(self):
+        return self.meter.rate()
+
+    def status(self):
+        return '{}/{} files, {} active, {} at {}/s'.format(
+            self.done_files, self.total_files, len(self.active),
+            format_bytes(self.bytes), format_bytes(self.rate()))
+
+    def summary(self, course=None, started=None, outcomes=None):
+        """
+        Aggregate the metrics of a course (or of everything so far), started
+        is when the course started, by default when the metrics did. Only
+        the files started since then count, so a course downloaded again
+        reports just the last run; outcomes are the resource outcomes of
+        that run, by default those of all the runs of the course.
+        """
+        with self.lock:
+            files = [f for f in self.files
+                     if (course is None or f.course == course) and
+                     (started is None or f.started >= started)]
+            if outcomes is None:
+                outcomes = self.outcomes if course is None \
+                    else self.course_outcomes[course]
+            ttfbs = [f.ttfb() for f in files if f.ttfb() is not None]
+            elapsed = time.time() - (started or self.started)
+            nbytes = sum(f.bytes for f in files)
+            transfer_time = sum(f.duration() for f in files)
+            result = {
+                'event': 'summary',
+                'course': course,
+                'outcomes': dict(outcomes),
+                'bytes': nbytes,
+                'elapsed': elapsed,
+                'throughput': nbytes / elapsed if elapsed > 0 else 0.0,
+                'file_throughput': nbytes / transfer_time if transfer_time > 0 else 0.0,
+                'ttfb_mean': sum(ttfbs) / len(ttfbs) if ttfbs else None,
+                'ttfb_max': max(ttfbs) if ttfbs else None,
+                'retries': sum(f.retries for f in files) if course else self.retries,
+            }
+            self._notify('summary', result)
+        return result
+
+
+class Renderer(object):
+
+    """
+    Base class of the metrics renderers, all hooks do nothing.
+    """
+
+    def file_start(self, metrics, record):
+        pass
+
+    def progress(self, metrics, record=None, nbytes=0):
+        pass
+
+    def file_done(self, metrics, record):
+        pass
+
+    def error(self, metrics, url, error, record=None):
+        pass
+
+    def resource_done(self, metrics, url, outcome, course=None):
+        pass
+
+    def summary(self, metrics, summary):
+        pass
+
+    def clear(self):
+        pass
+
+
+class StatusLine(Renderer):
+
+    """
+    The interactive single status line, redrawn at most every 'interval'
+    seconds.
+    """
+
+    def __init__(self, out=None, interval=0.1, width=70):
+        self.out = out or sys.stdout
+        self.interval = interval
+        self.width = width
+        self.last = 0
+
+    def progress(self, metrics, record=None, nbytes=0):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        status_str = 'status: ' + metrics.status()
+        self.out.write(status_str + ' ' * (self.width - len(status_str)) + '\r')
+        self.out.flush()
+
+    def clear(self):
+        self.out.write(' ' * self.width + '\r')
+        self.out.flush()
+
+
+class JsonLines(Renderer):
+
+    """
+    Writes a JSON object per completed file and per summary to a file, for
+    log processing.
+    """
+
+    def __init__(self, filename):
+        self.out = open(filename, 'a')
+
+    def write(self, obj):
+        self.out.write(json.dumps(obj, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def file_done(self, metrics, record):
+        self.write(record.as_dict())
+
+    def summary(self, metrics, summary):
+        self.write(summary)
+
+
+class Hooks(Renderer):
+
+    """
+    Calls plain functions on download events, for applications embedding
+    the downloader. All the hooks are optional, records are FileMetrics:
+
+        on_resource_start(record)       the transfer of a file starts
+        on_progress(record, nbytes)     nbytes more of the file arrived
+        on_complete(record)             the transfer ended, record.outcome
+                                        tells how
+        on_error(url, error, record)    a resource failed, record is None if
+                                        it failed before its transfer started
+        on_resource_done(url, outcome)  a resource is done with: downloaded,
+                                        skipped (or linked) or failed, also
+                                        when nothing was transferred
+
+    The hooks are called from the download worker threads, while the
+    metrics are locked, so they should return quickly.
+    """
+
+    def __init__(self, on_resource_start=None, on_progress=None,
+                 on_complete=None, on_error=None, on_resource_done=None):
+        self.on_resource_start = on_resource_start
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_resource_done = on_resource_done
+
+    def file_start(self, metrics, record):
+        if self.on_resource_start:
+            self.on_resource_start(record)
+
+    def progress(self, metrics, record=None, nbytes=0):
+        if self.on_progress and record:
+            self.on_progress(record, nbytes)
+
+    def file_done(self, metrics, record):
+        if self.on_complete:
+            self.on_complete(record)
+
+    def error(self, metrics, url, error, record=None):
+        if self.on_error:
+            self.on_error(url, error, record)
+
+    def resource_done(self, metrics, url, outcome, course=None):
+        if self.on_resource_done:
+            self.on_resource_done(url, outcome)
+
+
+def format_summary(summary):
+    """
+    Human readable report of a summary returned by DownloadMetrics.summary.
+    """
+    outcomes = summary['outcomes']
+    lines = [
+        "downloaded %d, skipped %d, failed %d" %
+        (outcomes.get('downloaded', 0), outcomes.get('skipped', 0),
+         outcomes.get('failed', 0)),
+        "%s in %.1fs (%s/s, %s/s per file), %d retries" %
+        (format_bytes(summary['bytes']), summary['elapsed'],
+         format_bytes(summary['throughput']),
+         format_bytes(summary['file_throughput']), summary['retries']),
+    ]
+    if summary['ttfb_mean'] is not None:
+        lines.append("time to first byte: mean %.3fs, max %.3fs" %
+                     (summary['ttfb_mean'], summary['ttfb_max']))
+    return lines
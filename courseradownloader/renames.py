@@ -0,0 +1,116 @@
+import os
+import threading
+from os import path
+from util import PART_EXT, SEGMENT_EXT, normalize_string
+
+# files in a course directory that are never taken for renamed resources
+IGNORED_EXTS = (PART_EXT, SEGMENT_EXT, '.link', '.tmp')
+
+
+def rename_key(filename):
+    """
+    What two names of the same resource have in common: the normalised name
+    (see normalize_string) and the extension.
+    """
+    name, ext = path.splitext(path.basename(filename))
+    return normalize_string(name), ext
+
+
+class RenameIndex(object):
+
+    """
+    Index of the files below a directory by normalised name and extension,
+    used to find files that were downloaded before under another name or in
+    another (e.g., renumbered) week or class directory.
+
+    The directory tree is walked once, on the first lookup, and kept up to
+    date with add(), remove() and move() as files change. Unless recursive,
+    only the files directly in the directory are indexed.
+
+    live_dirs are the directories the current course layout uses. Files in
+    other directories are left over from an earlier layout and can be taken
+    by any directory, files in a live directory only match within it: a
+    file of the same name and size elsewhere in the course is a different
+    resource.
+    """
+
+    def __init__(self, root, live_dirs=None, recursive=True):
+        self.root = path.abspath(root)
+        self.recursive = recursive
+        self.live_dirs = set(path.abspath(d) for d in live_dirs or [])
+        self.files = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.files = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                if fn.endswith(IGNORED_EXTS) or fn.startswith('.'):
+                    continue
+                filepath = path.join(dirpath, fn)
+                try:
+                    size = path.getsize(filepath)
+                except OSError:
+                    continue
+                self.files.setdefault(rename_key(fn), {})[filepath] = size
+            if not self.recursive:
+                break
+
+    def add(self, filepath, size=None):
+        filepath = path.abspath(filepath)
+        with self.lock:
+            if self.files is None:
+                return
+            if size is None:
+                size = path.getsize(filepath)
+            self.files.setdefault(rename_key(filepath), {})[filepath] = size
+
+    def remove(self, filepath):
+        filepath = path.abspath(filepath)
+        with self.lock:
+            if self.files is None:
+                return
+            self.files.get(rename_key(filepath), {}).pop(filepath, None)
+
+    def move(self, src, dst):
+        src, dst = path.abspath(src), path.abspath(dst)
+        with self.lock:
+            if self.files is None:
+                return
+            size = self.files.get(rename_key(src), {}).pop(src, None)
+            if size is not None:
+                self.files.setdefault(rename_key(dst), {})[dst] = size
+
+    def find(self, filepath, size):
+        """
+        Return the path of an existing file of the given size that filepath
+        is a renamed copy of, or None. Files in the same directory are
+        preferred, then those in directories whose names match once
+        normalised (i.e., without their numeric prefixes).
+        """
+        target = path.abspath(filepath)
+        target_dir = path.dirname(target)
+        with self.lock:
+            if self.files is None:
+                self._load()
+            candidates = [f for f, s in
+                          self.files.get(rename_key(target), {}).items()
+                          if s == size and f != target and
+                          (path.dirname(f) == target_dir or
+                           path.dirname(f) not in self.live_dirs)]
+        if not candidates:
+            return None
+
+        def closeness(candidate):
+            same_dir = path.dirname(candidate) == target_dir
+            # number of parent directories with matching names
+            same_names = 0
+            a, b = path.dirname(candidate), target_dir
+            while self.root not in (a, b) and path.dirname(a) != a and \
+                    normalize_string(path.basename(a)) == \
+                    normalize_string(path.basename(b)):
+                same_names += 1
+                a, b = path.dirname(a), path.dirname(b)
+            return (same_dir, same_names)
+
+        return max(sorted(candidates), key=closeness)
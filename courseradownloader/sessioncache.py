@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import time
+from os import path
+from requests.cookies import RequestsCookieJar, create_cookie
+from util import replace_file
+
+
+class SessionCache(object):
+
+    """
+    The cookies of a logged in session, kept on disk between runs so a run
+    can reuse the session instead of logging in again. There is one file per
+    user (named after the sha1 of the username) and, as the cookies are as
+    good as the password while they last, it is only readable by the owner.
+    """
+
+    def __init__(self, cache_dir, username):
+        self.cache_dir = cache_dir
+        self.filename = path.join(
+            cache_dir, hashlib.sha1(username.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self):
+        """
+        Return a cookie jar with the cookies of the cached session that have
+        not expired yet, None if there is no cached session.
+        """
+        try:
+            with open(self.filename) as f:
+                cookies = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        jar = RequestsCookieJar()
+        now = time.time()
+        for c in cookies:
+            if c.get('expires') and c['expires'] < now:
+                continue
+            jar.set_cookie(create_cookie(c['name'], c['value'],
+                                         domain=c['domain'], path=c['path'],
+                                         secure=c['secure'],
+                                         expires=c.get('expires')))
+        return jar
+
+    def save(self, jar):
+        """
+        Store the cookies of a session.
+        """
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain,
+                    'path': c.path, 'secure': c.secure, 'expires': c.expires}
+                   for c in jar]
+        if not path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        # create the file with restricted permissions rather than fixing
+        # them afterwards, so the cookies are never readable by others
+        tmpname = self.filename + '.tmp'
+        if path.exists(tmpname):
+            os.remove(tmpname)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f)
+        replace_file(tmpname, self.filename)
+
+    def clear(self):
+        if path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import threading
+import time
+from os import path
+from util import replace_file
+
+
+def link_file(src, dst):
+    """
+    Make dst a hard link to src, or a copy of it where hard links are not
+    possible (e.g., across filesystems). An existing dst is replaced.
+    """
+    tmp = dst + '.link'
+    if path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except (OSError, AttributeError):
+        shutil.copy2(src, tmp)
+    replace_file(tmp, dst)
+
+
+class ContentStore(object):
+
+    """
+    Content addressed store shared by all courses: every downloaded file is
+    kept once as a blob named after its sha1 checksum and hard linked into the
+    course directories that contain it, and an index maps resource urls to
+    blobs so a url fetched for any course is linked rather than downloaded
+    again.
+
+    Layout of the store directory:
+
+        objects/ab/cdef...    blobs, by sha1
+        index.jsonl           url -> sha1, size, name and validators
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = path.join(store_dir, 'objects')
+        self.index_file = path.join(store_dir, 'index.jsonl')
+        self.index = {}
+        self.lock = threading.Lock()
+        if not path.exists(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        self.load()
+
+    def load(self):
+        if not path.exists(self.index_file):
+            return
+        with open(self.index_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.index[entry['url']] = entry
+                except (ValueError, KeyError):
+                    continue
+
+    def blob_path(self, sha1):
+        return path.join(self.objects_dir, sha1[:2], sha1[2:])
+
+    def lookup(self, url):
+        """
+        Return the index entry of url if its blob is in the store.
+        """
+        entry = self.index.get(url)
+        if entry and path.exists(self.blob_path(entry['sha1'])):
+            return entry
+        return None
+
+    def link(self, entry, filepath):
+        """
+        Put the blob of an index entry at filepath.
+        """
+        link_file(self.blob_path(entry['sha1']), filepath)
+
+    def add(self, url, filepath, sha1, headers=None):
+        """
+        Add a downloaded file to the store. If the content is already stored
+        the file is replaced by a link to the blob, otherwise it becomes the
+        blob. Returns the index entry.
+        """
+        headers = headers or {}
+        blob = self.blob_path(sha1)
+        with self.lock:
+            if path.exists(blob):
+                link_file(blob, filepath)
+            else:
+                if not path.exists(path.dirname(blob)):
+                    os.makedirs(path.dirname(blob))
+                link_file(filepath, blob)
+
+            entry = {
+                'url': url,
+                'sha1': sha1,
+                'size': path.getsize(blob),
+                'name': path.basename(filepath),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'time': int(time.time()),
+            }
+            self.index[url] = entry
+            with open(self.index_file, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
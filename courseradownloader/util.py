@@ -1,9 +1,42 @@
+import ctypes
+import ctypes.util
+import os
 import re
+import requests
+import socket
+import threading
+import time
 import unicodedata
+from email.utils import mktime_tz, parsedate_tz
 from os import path
 from six import print_, PY2
+from six.moves import http_client, queue
 from six.moves.urllib.parse import unquote, urlparse, urlsplit
 
+# extension of files that are still being downloaded
+PART_EXT = '.part'
+
+# extension of files being fetched by a segmented download
+SEGMENT_EXT = '.segments'
+
+
+class IncompleteDownloadError(Exception):
+
+    """
+    Raised when a transfer ends before all the advertised data was received.
+    """
+
+
+def have_lxml():
+    """
+    Check if the lxml parser is available to BeautifulSoup.
+    """
+    try:
+        import lxml
+        return True
+    except ImportError:
+        return False
+
 
 def filename_from_header(header):
     try:
@@ -47,6 +80,191 @@ def filename_from_url(url):
     return sanitise_filename(fname)
 
 
+def parse_content_range(header):
+    """
+    Parse a "Content-Range: bytes a-b/n" header into a (a, b, n) tuple, n is
+    None if the total size is unknown. Returns None if the header is missing
+    or invalid.
+    """
+    m = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)',
+                 header.get('Content-Range', ''))
+    if not m:
+        return None
+    total = int(m.group(3)) if m.group(3) != '*' else None
+    return int(m.group(1)), int(m.group(2)), total
+
+
+def full_content_length(response):
+    """
+    Return the size of the complete resource a response is for, which for a
+    partial (206) response comes from the Content-Range header. Returns -1 if
+    it is not known.
+    """
+    if response.status_code == 206:
+        crange = parse_content_range(response.headers)
+        if crange and crange[2] is not None:
+            return crange[2]
+        return -1
+    return int(response.headers.get('Content-Length', -1))
+
+
+def segment_bounds(size, n):
+    """
+    Split a file of the given size into (at most) n contiguous byte ranges,
+    returned as inclusive (start, end) tuples.
+    """
+    n = max(1, min(n, size))
+    step = size // n
+    bounds = []
+    for i in range(n):
+        start = i * step
+        end = size - 1 if i == n - 1 else start + step - 1
+        bounds.append((start, end))
+    return bounds
+
+
+def retry_after_seconds(header):
+    """
+    Return the number of seconds a Retry-After header (either a number of
+    seconds or an HTTP date) asks to wait, None if there is no valid one.
+    """
+    value = header.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if not date:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+def validator_headers(entry):
+    """
+    Build the headers of a conditional request from a dict holding the
+    'etag' and 'last_modified' validators of an earlier response.
+    """
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def if_range(headers):
+    """
+    The If-Range header value that makes a range request for the version
+    of a resource the given response headers describe: its ETag, unless it
+    is weak (those cannot be used with ranges), or else its Last-Modified
+    date. None if there is neither.
+    """
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def default_cache_dir():
+    """
+    Directory where coursera-dl keeps its state between runs.
+    """
+    return path.join(path.expanduser('~'), '.coursera-dl')
+
+
+def partial_size(filepath):
+    """
+    Return the size of the partial download of filepath, 0 if there is none.
+    """
+    partpath = filepath + PART_EXT
+    return path.getsize(partpath) if path.exists(partpath) else 0
+
+
+def iter_into(response, buf, limit=-1):
+    """
+    Stream the body of response through buf, a bytearray that is reused for
+    every chunk, yielding a memoryview of each chunk read. A chunk is only
+    valid until the next one is read. At most limit bytes are read if limit
+    is not negative.
+
+    urllib3 reads into a new bytes object even when asked to readinto, so
+    the body is read from the underlying http_client response, which fills
+    buf itself (and takes care of chunked transfer encoding). A body that
+    has to be decoded, or a response without one (python 2), falls back to
+    iter_content. Errors are raised as iter_content would.
+    """
+    fp = getattr(response.raw, '_fp', None)
+    encoding = response.headers.get('Content-Encoding', 'identity').lower()
+    if encoding != 'identity' or not hasattr(fp, 'readinto'):
+        for data in response.iter_content(len(buf)):
+            if 0 <= limit < len(data):
+                data = data[:limit]
+            if limit >= 0:
+                limit -= len(data)
+            yield memoryview(data)
+            if limit == 0:
+                return
+        return
+
+    view = memoryview(buf)
+    while limit != 0:
+        size = len(buf) if limit < 0 else min(len(buf), limit)
+        try:
+            n = fp.readinto(view[:size])
+        except http_client.IncompleteRead as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except socket.error as e:
+            raise requests.exceptions.ConnectionError(e)
+        if not n:
+            break
+        if limit > 0:
+            limit -= n
+        yield view[:n]
+    # urllib3 did not see the body go by, hand the connection back to its
+    # pool itself if the body was read completely
+    if fp.isclosed():
+        response.raw.release_conn()
+
+
+_fallocate = None
+
+
+def preallocate(f, size):
+    """
+    Reserve the disk space for a file that is going to grow to size bytes,
+    so it is laid out in one piece instead of block by block as it is
+    written. The size of the file does not change, a partial download still
+    has the size of what was written. Only done where the system supports
+    it (Linux), elsewhere, or if the filesystem does not, nothing happens.
+    """
+    global _fallocate
+    if _fallocate is None:
+        _fallocate = False
+        libc = ctypes.util.find_library('c')
+        if libc and hasattr(ctypes.CDLL(libc), 'fallocate'):
+            _fallocate = ctypes.CDLL(libc).fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_int64, ctypes.c_int64]
+    if _fallocate and size > 0:
+        FALLOC_FL_KEEP_SIZE = 1
+        # failure just means the file is allocated as it is written
+        _fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, 0, size)
+
+
+def replace_file(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # python 2 cannot atomically replace an existing file on windows
+        if os.name == 'nt' and path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def clean_url(url):
     if not url:
         return None
@@ -87,6 +305,10 @@ def sanitise_filename(fileName):
     return s
 
 
+def normalize_string(str):
+    return ''.join(x for x in str if x not in ' \t-_()"01234567890').lower()
+
+
 def trim_path(pathname, max_path_len=255, min_len=5):
     """
     Trim file name in given path name to fit max_path_len characters. Only file name is trimmed,
@@ -112,3 +334,188 @@ def trim_path(pathname, max_path_len=255, min_len=5):
            (pathname, new_pathname, max_path_len))
 
     return new_pathname
+
+
+def parallel_map(func, items, jobs=1):
+    """
+    Apply func to every item using a pool of at most 'jobs' worker threads and
+    return the results in the original order. Exceptions raised by func are
+    returned in place of the result, so one failing item does not abort the
+    others.
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    if jobs <= 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                results[i] = e
+        return results
+
+    q = queue.Queue()
+    for i, item in enumerate(items):
+        q.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = q.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def pipeline_map(func, items, jobs=1, queue_size=None):
+    """
+    Like parallel_map, but items can be a generator that produces them
+    slowly: it is consumed in a producer thread while the workers apply func
+    to what it produced so far, with at most queue_size (by default twice
+    the number of workers) items waiting. Returns the list of (item, result)
+    pairs in the order the items were produced. An exception raised by the
+    generator is raised once the items produced before it are processed.
+    """
+    jobs = max(1, jobs)
+    q = queue.Queue(queue_size or 2 * jobs)
+    produced = []
+    results = {}
+    failure = []
+    done = object()
+
+    def producer():
+        try:
+            for i, item in enumerate(items):
+                produced.append(item)
+                q.put((i, item))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            for _ in range(jobs):
+                q.put(done)
+
+    def worker():
+        while True:
+            task = q.get()
+            if task is done:
+                return
+            i, item = task
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=producer)]
+    threads += [threading.Thread(target=worker) for _ in range(jobs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if failure:
+        raise failure[0]
+    return [(item, results[i]) for i, item in enumerate(produced)]
+
+
+def format_bytes(n):
+    """Human readable representation of a byte count"""
+    if n < 1024:
+        return '{:.0f} B'.format(n)
+    elif n < 1048576:
+        return '{:.1f} KB'.format(n / 1024.0)
+    elif n < 1073741824:
+        return '{:.1f} MB'.format(n / 1048576.0)
+    else:
+        return '{:.2f} GB'.format(n / 1073741824.0)
+
+
+class ConnectionLimiter(object):
+
+    """
+    Counting semaphore that caps the number of concurrent connections and can
+    hand out several slots at once.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.available = limit
+        self.cond = threading.Condition()
+
+    def acquire(self, n=1):
+        """
+        Wait until n slots (at most the limit) are free and take them.
+        """
+        n = min(n, self.limit)
+        with self.cond:
+            while self.available < n:
+                self.cond.wait()
+            self.available -= n
+
+    def try_acquire(self, n):
+        """
+        Take up to n slots without waiting, returns how many were taken.
+        """
+        with self.cond:
+            n = max(0, min(n, self.available))
+            self.available -= n
+            return n
+
+    def release(self, n=1):
+        n = min(n, self.limit)
+        with self.cond:
+            self.available += n
+            self.cond.notify_all()
+
+
+class TokenBucket(object):
+
+    """
+    Thread safe token bucket refilled at 'rate' tokens per second, holding at
+    most 'capacity' (by default one second worth of) tokens. consume() may
+    take more tokens than are available, the caller then sleeps until the
+    debt is paid off, which also makes callers queue up fairly.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or self.rate
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n=1):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_size(s):
+    """
+    Parse a size such as "500K", "1.5M" or "2g" into a number of bytes.
+    """
+    s = str(s).strip()
+    units = {'k': 1024, 'm': 1048576, 'g': 1073741824}
+    mult = units.get(s[-1:].lower())
+    if mult:
+        s = s[:-1]
+    return int(float(s) * (mult or 1))
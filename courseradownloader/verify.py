@@ -0,0 +1,149 @@
+import hashlib
+import struct
+
+# outcomes of the verification of a file
+OK = 'ok'
+BROKEN = 'broken'
+REPAIRED = 'repaired'
+UNVERIFIED = 'unverified'
+
+
+class Mp4Walker(object):
+
+    """
+    Check that a file of the given size is a complete mp4 file, as its data
+    is fed to it in order: its top level boxes must add up to exactly its
+    size and include the movie box ('moov') without which it cannot be
+    played. Only the box headers are looked at, so the data between them
+    may be skipped (see needed).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.box = 0
+        self.header = b''
+        self.types = set()
+        self.error = None
+
+    def needed(self):
+        """
+        Position of the next byte the walker needs, None once it has seen
+        all it needs.
+        """
+        if self.error or self.box >= self.size:
+            return None
+        return self.box + len(self.header)
+
+    def feed(self, offset, data):
+        """
+        Look at data, the bytes of the file from offset on.
+        """
+        end = offset + len(data)
+        while True:
+            pos = self.needed()
+            if pos is None or not offset <= pos < end:
+                return
+            # 8 bytes of size and type, followed by a 64 bit size if the
+            # size is 1
+            want = 16 if len(self.header) >= 8 else 8
+            self.header += data[pos - offset:pos - offset + want - len(self.header)]
+            if len(self.header) < want:
+                return
+            box_size, box_type = struct.unpack('>I4s', self.header[:8])
+            if want == 8 and box_size == 1:
+                continue
+            if box_size == 1:
+                box_size = struct.unpack('>Q', self.header[8:16])[0]
+            elif box_size == 0:
+                # the box extends to the end of the file
+                box_size = self.size - self.box
+            if box_size < len(self.header):
+                self.error = 'invalid box at byte %d' % self.box
+            elif self.box + box_size > self.size:
+                self.error = "'%s' box truncated (%d of %d bytes)" % (
+                    box_type.decode('latin-1'), self.size - self.box, box_size)
+            else:
+                self.types.add(box_type)
+                self.box += box_size
+                self.header = b''
+
+    def problem(self):
+        """
+        What is wrong with the file, None if nothing is.
+        """
+        if self.error:
+            return self.error
+        if self.box < self.size:
+            return 'truncated box header at byte %d' % self.box
+        if b'moov' not in self.types:
+            return "no 'moov' box"
+        return None
+
+
+def scan_file(f, size, checksum=True, is_mp4=False, bufsize=1048576):
+    """
+    Read a file object holding size bytes once, from its current position
+    to the end, computing its sha1 checksum (if checksum is set) and, for a
+    video, what is wrong with it as an mp4 file (see Mp4Walker). The file
+    is only read forward, which keeps this cheap for the members of a
+    compressed tarball. Returns the checksum and the mp4 problem, either
+    None if not asked for.
+    """
+    hasher = hashlib.sha1() if checksum else None
+    walker = Mp4Walker(size) if is_mp4 else None
+    pos = 0
+    while hasher or (walker and walker.needed() is not None):
+        if not hasher:
+            # only the box headers are needed, skip to the next one
+            f.seek(walker.needed())
+            pos = walker.needed()
+            data = f.read(16)
+        else:
+            data = f.read(bufsize)
+        if not data:
+            break
+        if hasher:
+            hasher.update(data)
+        if walker:
+            walker.feed(pos, data)
+        pos += len(data)
+    return (hasher.hexdigest() if hasher else None,
+            walker.problem() if walker else None)
+
+
+def fileobj_checksum(f, bufsize=1048576):
+    """
+    Return the sha1 hex digest of what is left to read of a file object.
+    """
+    return scan_file(f, -1, bufsize=bufsize)[0]
+
+
+def scan_problem(size, sha1=None, mp4=None, entry=None, clen=-1):
+    """
+    Judge a file of the given size from what scan_file found (its checksum
+    and mp4 problem) and what is known about it: the manifest entry it was
+    recorded with (size and sha1 checksum) and the size of the resource on
+    the server (clen, -1 if not known). Returns what is wrong with the file,
+    None if nothing is.
+    """
+    if entry:
+        if size != entry['size']:
+            return 'size %d, recorded as %d' % (size, entry['size'])
+        if entry.get('sha1') and sha1 != entry['sha1']:
+            return 'checksum mismatch'
+    if clen > 0 and size != clen:
+        return 'size %d, the server has %d' % (size, clen)
+    return mp4
+
+
+def file_problem(f, size, entry=None, clen=-1, is_mp4=False):
+    """
+    Check a file (a file object holding size bytes) against what is known
+    about it, see scan_problem. Videos are also checked to be complete mp4
+    files. Returns what is wrong with the file, None if nothing is.
+    """
+    if entry and size != entry['size']:
+        return scan_problem(size, entry=entry)
+    checksum = bool(entry and entry.get('sha1'))
+    sha1, mp4 = scan_file(f, size, checksum, is_mp4)
+    return scan_problem(size, sha1, mp4, entry, clen)
@@ -0,0 +1,165 @@
+import errno
+import json
+import os
+import socket
+import time
+from os import path
+from util import replace_file
+
+# states of a work item, each a directory holding the items in that state
+TODO = 'todo'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (TODO, CLAIMED, DONE, FAILED)
+
+
+def default_worker_id():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+
+    """
+    Queue of download tasks kept in a directory that several workers, on
+    one machine or sharing it over a network filesystem, drain together.
+
+    Every item is a small JSON file that moves between the todo, claimed,
+    done and failed directories of its course:
+
+        <queue dir>/<course>/todo/000001.json
+
+    A worker claims an item by renaming it into the claimed directory under
+    a name carrying its worker id. The rename is atomic, so of several
+    workers going for the same item exactly one succeeds and the others
+    move on to the next item; no locks are needed, which is what makes this
+    work on NFS and SMB shares where file locking is unreliable. Claims of
+    workers that died are put back with requeue_stale().
+    """
+
+    def __init__(self, queue_dir, worker_id=None):
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or default_worker_id()
+
+    def state_dir(self, course, state):
+        return path.join(self.queue_dir, course, state)
+
+    def courses(self, courses=None):
+        """
+        The courses in the queue, out of the given ones if any.
+        """
+        if not path.exists(self.queue_dir):
+            return []
+        return sorted(c for c in courses or os.listdir(self.queue_dir)
+                      if path.isdir(self.state_dir(c, TODO)))
+
+    def add(self, course, items):
+        """
+        Add a list of items (JSON serialisable dicts) of a course to the
+        queue. Returns the number of items added. A course can only be added
+        once, remove its directory from the queue to start it afresh.
+        """
+        if path.exists(path.join(self.queue_dir, course)):
+            raise ValueError("%s is already in the work queue %s" %
+                             (course, self.queue_dir))
+        for state in STATES:
+            if not path.exists(self.state_dir(course, state)):
+                os.makedirs(self.state_dir(course, state))
+
+        todo = self.state_dir(course, TODO)
+        for i, item in enumerate(items, start=1):
+            item = dict(item, course=course, id='%06d' % i)
+            filename = path.join(todo, item['id'] + '.json')
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(item, f, sort_keys=True)
+            replace_file(filename + '.tmp', filename)
+        return len(items)
+
+    def claim(self, courses=None):
+        """
+        Claim the next item of one of the given courses (by default any
+        course). Returns the claimed item, or None once there is nothing
+        left to claim.
+        """
+        for course in self.courses(courses):
+            todo = self.state_dir(course, TODO)
+            for fn in sorted(os.listdir(todo)):
+                if not fn.endswith('.json'):
+                    continue
+                claimed = path.join(self.state_dir(course, CLAIMED),
+                                    '%s.%s' % (fn, self.worker_id))
+                try:
+                    os.rename(path.join(todo, fn), claimed)
+                except OSError as e:
+                    # another worker got there first
+                    if e.errno in (errno.ENOENT, errno.EEXIST):
+                        continue
+                    raise
+                # mark the time of the claim for requeue_stale
+                os.utime(claimed, None)
+                with open(claimed) as f:
+                    item = json.load(f)
+                item['claim'] = claimed
+                return item
+        return None
+
+    def complete(self, item, outcome, failed=False):
+        """
+        Record the outcome of a claimed item, moving it to the done (or
+        failed) directory of its course.
+        """
+        state = FAILED if failed else DONE
+        record = dict(item, outcome=outcome, worker=self.worker_id,
+                      time=int(time.time()))
+        claimed = record.pop('claim')
+        filename = path.join(self.state_dir(item['course'], state),
+                             item['id'] + '.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(record, f, sort_keys=True)
+        replace_file(filename + '.tmp', filename)
+        try:
+            os.remove(claimed)
+        except OSError as e:
+            # the claim went stale and was requeued in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+
+    def requeue_stale(self, lease, courses=None):
+        """
+        Put the claims older than lease seconds (those of workers that died)
+        and the failed items back in the todo directories. Returns the
+        number of items requeued.
+        """
+        now = time.time()
+        n = 0
+        for course in self.courses(courses):
+            todo = self.state_dir(course, TODO)
+            for state in (CLAIMED, FAILED):
+                dirname = self.state_dir(course, state)
+                for fn in os.listdir(dirname):
+                    if fn.endswith('.tmp'):
+                        continue
+                    filepath = path.join(dirname, fn)
+                    if state == CLAIMED and now - path.getmtime(filepath) < lease:
+                        continue
+                    # claims are named <id>.json.<worker id>
+                    name = fn.split('.json')[0] + '.json'
+                    try:
+                        os.rename(filepath, path.join(todo, name))
+                        n += 1
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+        return n
+
+    def counts(self, courses=None):
+        """
+        Number of items per state, over the given courses (by default all).
+        """
+        counts = dict((state, 0) for state in STATES)
+        for course in self.courses(courses):
+            for state in STATES:
+                counts[state] += len([fn for fn in os.listdir(
+                    self.state_dir(course, state)) if '.json' in fn and
+                    not fn.endswith('.tmp')])
+        return counts